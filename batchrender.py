@@ -0,0 +1,226 @@
+"""Headless rendering of formulas to svg/png files, a JSON lines stream or a formula library.
+
+Formulas are read from a session file or streamed from stdin (one formula per line,
+optionally wrapped in ``\\[...\\]``), typeset on a pool of MathJax pages with the same
+template and config the GUI uses, and written out in input order.
+"""
+import json, logging, os, sys
+from functools import partial
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+from renderpool import backends, default_backend
+from session import SessionStore, is_session_file, parse_text_session
+from svgcache import SvgCache
+
+
+def add_arguments(parser):
+    parser.add_argument('input', nargs='?', default='-',
+                        help='session file to render, or - to read formulas from stdin')
+    parser.add_argument('-f', '--format', choices=['svg', 'png', 'jsonl', 'library'],
+                        default='jsonl',
+                        help='write svg or png files, a JSON lines stream (default) or a '
+                             'formula library (see formulalib)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output directory for svg/png, or file for jsonl (default stdout) '
+                             'and library')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of render pages to run in parallel')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='formulas typeset per round trip')
+    parser.add_argument('--scale', type=float, default=1.0, help='scale for png output')
+    parser.add_argument('--no-cache', action='store_true', help="don't use the svg cache")
+    parser.add_argument('--backend', choices=backends, default=default_backend,
+                        help='typeset in QtWebEngine pages or in node processes with mathjax-full')
+
+
+def strip_delimiters(line:str) -> str:
+    formula = line.strip()
+    if formula.startswith('\\[') and formula.endswith('\\]'):
+        formula = formula[2:-2]
+    return formula
+
+
+def session_formulas(filename):
+    if is_session_file(filename):
+        store = SessionStore(filename)
+        rows = store.rows()
+        while rows:
+            for _, formula, _, _ in rows:
+                yield formula
+            rows = store.rows(rows[-1][0])
+        store.close()
+    else:
+        with open(filename, 'rt') as f:
+            yield from parse_text_session(f.read())
+
+
+class StdinReader(QThread):
+    """Reads formulas from stdin in the background so they can be rendered as they arrive."""
+    formulaRead = pyqtSignal(str)
+
+    def __init__(self, stream=sys.stdin, parent=None):
+        super().__init__(parent)
+        self.stream = stream
+
+    def run(self):
+        for line in self.stream:
+            formula = strip_delimiters(line)
+            if formula:
+                self.formulaRead.emit(formula)
+
+
+class FileWriter:
+    def __init__(self, directory, format, scale=1.0):
+        self.directory = directory
+        self.format = format
+        self.scale = scale
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, index, formula, svg:bytes):
+        path = os.path.join(self.directory, '{:06d}.{}'.format(index, self.format))
+        if self.format == 'png':
+            from svgraster import svg_image
+            if not svg_image(svg, scale=self.scale).save(path):
+                logging.error('could not write {}'.format(path))
+        else:
+            with open(path, 'wb') as f:
+                f.write(svg)
+
+    def close(self):
+        pass
+
+
+class JsonlWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, index, formula, svg:bytes):
+        self.stream.write(json.dumps({'index': index, 'formula': formula,
+                                      'svg': svg.decode()}) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+
+class LibraryWriter:
+    def __init__(self, filename):
+        from formulalib import LibraryWriter
+        self.writer = LibraryWriter(filename)
+
+    def write(self, index, formula, svg:bytes):
+        self.writer.add(formula, svg)
+
+    def close(self):
+        self.writer.close()
+
+
+class BatchRenderer(QObject):
+    """Renders formulas as they are added and writes them out in the order they were added.
+
+    Formulas are gathered into batches of ``batch_size``; a partly filled batch is sent
+    after a short pause in the input so streamed formulas don't wait for a full batch.
+    ``finished`` is emitted once ``close`` has been called and everything is written.
+
+    Batches go through a RenderService, so a page that hangs or dies only fails the
+    formula that caused it (see RenderService._fail), and every formula gets written out.
+    """
+    finished = pyqtSignal()
+
+    def __init__(self, writer, jobs=None, batch_size=32, cache=None, parent=None, backend=None):
+        super().__init__(parent)
+        from renderservice import RenderService, NORMAL
+        self.writer = writer
+        self.service = RenderService(jobs, cache if cache is not None else False, self, backend)
+        # the batches are all there is; BULK would keep a page idle for urgent work
+        self.priority = NORMAL
+        self.batch_size = batch_size
+        self.queue = []
+        self.batch = []
+        self.written = 0
+        self.closed = False
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(20)
+        self.timer.timeout.connect(self.flush)
+
+    def add(self, formula:str):
+        entry = [formula, self.service.cached(formula)]
+        self.queue.append(entry)
+        if entry[1] is not None:
+            self._write_ready()
+            return
+
+        self.batch.append(entry)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        else:
+            self.timer.start()
+
+    def flush(self):
+        self.timer.stop()
+        batch, self.batch = self.batch, []
+        if batch:
+            self.service.submit_batch([formula for formula, _ in batch],
+                                      partial(self._rendered, batch), self.priority)
+
+    def close(self):
+        self.closed = True
+        self.flush()
+        self._write_ready()
+
+    def _rendered(self, batch, svgs):
+        # minified and cached by the service; a failed formula comes back as b''
+        for entry, svg in zip(batch, svgs):
+            entry[1] = svg
+        self._write_ready()
+
+    def _write_ready(self):
+        while self.queue and self.queue[0][1] is not None:
+            formula, svg = self.queue.pop(0)
+            if b'<svg' not in svg:
+                logging.error('formula {} failed to render: {}'.format(self.written, formula))
+            self.writer.write(self.written, formula, svg)
+            self.written += 1
+
+        if self.closed and not self.queue:
+            self.writer.close()
+            self.finished.emit()
+
+
+def main(args):
+    # there is no window to show, so don't require a display
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QApplication
+    # QtWebEngine is imported after the application exists, and not at all for node
+    QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    app = QApplication(sys.argv[:1])
+
+    if args.format == 'jsonl':
+        writer = JsonlWriter(open(args.output, 'wt') if args.output else sys.stdout)
+    elif args.format == 'library' and args.output:
+        writer = LibraryWriter(args.output)
+    elif args.output:
+        writer = FileWriter(args.output, args.format, args.scale)
+    else:
+        logging.critical('--output is required for {} output'.format(args.format))
+        return 2
+
+    renderer = BatchRenderer(writer, args.jobs, args.batch_size,
+                             None if args.no_cache else SvgCache(), backend=args.backend)
+    renderer.finished.connect(app.quit)
+
+    if args.input == '-':
+        reader = StdinReader()
+        reader.formulaRead.connect(renderer.add)
+        reader.finished.connect(renderer.close)
+        reader.start()
+    else:
+        for formula in session_formulas(args.input):
+            if formula:
+                renderer.add(formula)
+        renderer.close()
+
+    return app.exec_() if not renderer.closed or renderer.queue else 0
@@ -0,0 +1,305 @@
+"""Render benchmarks over a fixed corpus of formulas, run offscreen.
+
+Each stage of the pipeline is timed separately:
+
+- ``setHtml``: the old per-formula page load of ``mjrender.page_template``
+- ``extract``: pulling the svg out of that page with ``runJavaScript``
+- ``typeset``: MathJax typesetting in the persistent engine page, timed inside the page
+- ``svg_extract``: serializing the typeset svg inside the engine page
+- ``roundtrip``: submit to callback for one formula on the engine page
+- ``insert``: adding the svg to a FormulaList
+- ``rasterize``: painting the svg to a pixmap for the list
+- ``pool``: typesetting the whole corpus in batches on a RenderPool, with either backend
+
+The report gives throughput and p50/p95/p99 latency per stage and peak RSS, as JSON so
+runs can be compared across commits.
+"""
+import json, os, resource, subprocess, sys, time
+from collections import defaultdict
+from PyQt5.QtCore import QObject, QUrl, pyqtSignal
+from renderpool import backends, default_backend
+
+corpus = {
+    'inline': [
+        r'x^2+y^2=z^2',
+        r'e^{i\pi}+1=0',
+        r'\alpha_i \beta^j',
+        r'a \ne b',
+        r'\sqrt{2}',
+        r'f(x) = \sin x + \cos x',
+        r'\frac{a}{b}',
+        r'\Ex[X] = \mu',
+    ],
+    'matrix': [
+        r'\begin{pmatrix} a & b \\ c & d \end{pmatrix}',
+        r'\begin{bmatrix} 1 & 0 & 0 & 0 \\ 0 & 1 & 0 & 0 \\ 0 & 0 & 1 & 0 \\ 0 & 0 & 0 & 1 \end{bmatrix}',
+        r'A = \begin{pmatrix} a_{11} & a_{12} & \cdots & a_{1n} \\ a_{21} & a_{22} & \cdots & a_{2n} \\'
+        r' \vdots & \vdots & \ddots & \vdots \\ a_{m1} & a_{m2} & \cdots & a_{mn} \end{pmatrix}',
+        r'\det \begin{vmatrix} x_1 & y_1 & 1 \\ x_2 & y_2 & 1 \\ x_3 & y_3 & 1 \end{vmatrix}',
+    ],
+    'align': [
+        r'\begin{align} f(x) &= (x+1)^2 \\ &= x^2 + 2x + 1 \end{align}',
+        r'\begin{align} \nabla \cdot \mathbf{E} &= \frac{\rho}{\varepsilon_0} \\'
+        r' \nabla \cdot \mathbf{B} &= 0 \\ \nabla \times \mathbf{E} &= -\frac{\partial \mathbf{B}}{\partial t} \\'
+        r' \nabla \times \mathbf{B} &= \mu_0 \mathbf{J} + \mu_0 \varepsilon_0 \frac{\partial \mathbf{E}}{\partial t}'
+        r' \end{align}',
+        r'\begin{align} \int_0^\infty e^{-x^2}\,dx &= \frac{\sqrt{\pi}}{2} \\'
+        r' \sum_{n=1}^\infty \frac{1}{n^2} &= \frac{\pi^2}{6} \\'
+        r' \prod_{p} \frac{1}{1-p^{-s}} &= \sum_{n=1}^\infty \frac{1}{n^s} \end{align}',
+    ],
+}
+
+stage_names = ['setHtml', 'extract', 'typeset', 'svg_extract', 'roundtrip', 'insert', 'rasterize', 'pool']
+
+
+def add_arguments(parser):
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='passes over the corpus')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='pages in the pool stage')
+    parser.add_argument('-o', '--output', default=None, help='write the JSON report here')
+    parser.add_argument('--backend', choices=backends, default=default_backend,
+                        help='backend for the pool stage')
+    parser.add_argument('--skip-legacy', action='store_true',
+                        help='skip the setHtml/extract stages of the old pipeline')
+
+
+def percentile(samples, fraction):
+    # nearest rank
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def peak_rss_kb():
+    """Peak RSS of this process and of the web engine processes it started, in kB."""
+    rss = {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'children': 0}
+    try:
+        pids = []
+        for task in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/{}/children'.format(task)) as f:
+                pids.extend(f.read().split())
+        for pid in pids:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        rss['children'] += int(line.split()[1])
+    except OSError:
+        pass
+    return rss
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark(QObject):
+    """Runs the stages one after another; ``finished`` is emitted when the report is ready."""
+    finished = pyqtSignal()
+
+    def __init__(self, formulas, jobs=None, skip_legacy=False, parent=None, backend=None):
+        super().__init__(parent)
+        self.formulas = formulas
+        self.jobs = jobs
+        self.backend = backend
+        self.samples = defaultdict(list)
+        self.walls = {}
+        self.svgs = []
+        self.steps = [self.run_engine, self.run_insert, self.run_pool]
+        if not skip_legacy:
+            self.steps.insert(0, self.run_legacy)
+
+    def run(self):
+        self.started = time.perf_counter()
+        self.next_step()
+
+    def next_step(self):
+        if self.steps:
+            self.steps.pop(0)()
+        else:
+            self.finished.emit()
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def run_legacy(self):
+        from PyQt5.QtWebEngineWidgets import QWebEnginePage
+        from mjrender import page_template
+
+        page = QWebEnginePage(self)
+        pending = list(self.formulas)
+        state = {}
+        wall = time.perf_counter()
+
+        def load_next():
+            if not pending:
+                self.walls['setHtml'] = self.walls['extract'] = time.perf_counter() - wall
+                page.deleteLater()
+                self.next_step()
+                return
+            state['start'] = time.perf_counter()
+            page.setHtml(page_template.format(formula=pending.pop(0)), QUrl('file://'))
+
+        def loaded(ok):
+            state['loaded'] = time.perf_counter()
+            self.record('setHtml', state['loaded'] - state['start'])
+            page.runJavaScript("""
+                var mjelement = document.getElementById('mathjax-container');
+                var svg = mjelement.getElementsByTagName('svg')[0];
+                svg ? svg.outerHTML : '';
+            """, extracted)
+
+        def extracted(result):
+            self.record('extract', time.perf_counter() - state['loaded'])
+            load_next()
+
+        page.loadFinished.connect(loaded)
+        load_next()
+
+    def run_engine(self):
+        from mjrender import MathJaxRenderer
+
+        renderer = MathJaxRenderer(self)
+        pending = list(self.formulas)
+        state = {}
+        wall = {}
+
+        def timed(job, timings):
+            for typeset, extract in timings:
+                self.record('typeset', typeset / 1000)
+                self.record('svg_extract', extract / 1000)
+
+        def submit_next(*args):
+            if not pending:
+                self.walls['roundtrip'] = time.perf_counter() - wall['start']
+                self.walls['typeset'] = sum(self.samples['typeset'])
+                self.walls['svg_extract'] = sum(self.samples['svg_extract'])
+                renderer.deleteLater()
+                self.next_step()
+                return
+            state['start'] = time.perf_counter()
+            renderer.submit(pending.pop(0), rendered)
+
+        def rendered(svg):
+            self.record('roundtrip', time.perf_counter() - state['start'])
+            self.svgs.append(svg)
+            submit_next()
+
+        def ready(version):
+            self.mathjax_version = version
+            wall['start'] = time.perf_counter()
+            submit_next()
+
+        renderer.timed.connect(timed)
+        renderer.ready.connect(ready)
+
+    def run_insert(self):
+        from formulalist import FormulaList
+        from svgraster import svg_pixmap, list_padding
+
+        formula_list = FormulaList()
+        formula_list.resize(600, 800)
+        wall = time.perf_counter()
+        for formula, svg in zip(self.formulas, self.svgs):
+            start = time.perf_counter()
+            formula_list.append_formula_svg(formula, svg)
+            self.record('insert', time.perf_counter() - start)
+        self.walls['insert'] = time.perf_counter() - wall
+
+        wall = time.perf_counter()
+        for scale, svg in enumerate(self.svgs):
+            # a distinct scale per formula keeps every rasterization a cache miss
+            start = time.perf_counter()
+            svg_pixmap(svg, scale=0.05 + scale / 1e6, padding=list_padding)
+            self.record('rasterize', time.perf_counter() - start)
+        self.walls['rasterize'] = time.perf_counter() - wall
+
+        formula_list.deleteLater()
+        self.next_step()
+
+    def run_pool(self):
+        from renderpool import RenderPool
+
+        pool = RenderPool(self.jobs, self, self.backend)
+        batch_size = max(1, -(-len(self.formulas) // pool.size))
+        batches = [self.formulas[i:i + batch_size] for i in range(0, len(self.formulas), batch_size)]
+        state = {'left': len(batches), 'start': time.perf_counter()}
+
+        def rendered(start, svgs):
+            self.record('pool', (time.perf_counter() - start) / max(1, len(svgs)))
+            state['left'] -= 1
+            if state['left'] == 0:
+                self.walls['pool'] = time.perf_counter() - state['start']
+                self.pool_size = len(pool.pages)
+                self.next_step()
+
+        for batch in batches:
+            pool.submit_batch(batch, lambda svgs, start=time.perf_counter(): rendered(start, svgs))
+
+    def report(self):
+        stages = {}
+        for stage in stage_names:
+            samples = self.samples.get(stage)
+            if not samples:
+                continue
+            wall = self.walls.get(stage) or sum(samples)
+            stages[stage] = {
+                'count': len(samples),
+                'total_s': wall,
+                'throughput_per_s': len(samples) / wall if wall else None,
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p95_ms': percentile(samples, 0.95) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+            }
+
+        return {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'mathjax_version': getattr(self, 'mathjax_version', None),
+            'formulas': len(self.formulas),
+            'pool_pages': getattr(self, 'pool_size', None),
+            'pool_backend': self.backend,
+            'elapsed_s': time.perf_counter() - self.started,
+            'stages': stages,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+def print_table(report, stream=sys.stderr):
+    print('{:<12} {:>6} {:>10} {:>9} {:>9} {:>9}'.format(
+        'stage', 'count', 'per sec', 'p50 ms', 'p95 ms', 'p99 ms'), file=stream)
+    for stage, stats in report['stages'].items():
+        print('{:<12} {:>6} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            stage, stats['count'], stats['throughput_per_s'] or 0,
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms']), file=stream)
+    print('peak rss: {self} kB (web engine processes: {children} kB)'.format(
+        **report['peak_rss_kb']), file=stream)
+
+
+def main(args):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QApplication
+    # the stages import QtWebEngine after the application exists
+    QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    app = QApplication(sys.argv[:1])
+
+    formulas = [formula for group in corpus.values() for formula in group] * args.repeat
+    benchmark = Benchmark(formulas, args.jobs, args.skip_legacy, backend=args.backend)
+    benchmark.finished.connect(app.quit)
+    benchmark.run()
+    app.exec_()
+
+    report = benchmark.report()
+    print_table(report)
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
@@ -0,0 +1,136 @@
+from PyQt5.QtCore import Qt, QEvent
+from PyQt5.QtWidgets import QWidget, QHBoxLayout, QLineEdit, QLabel, QToolButton, QAbstractItemView
+
+
+class FindBar(QWidget):
+    """Find-as-you-type over the formulas in a FormulaList (see searchindex for the query syntax).
+
+    With SessionTabs (see ``setSessionTabs``) every open session is searched, and going to a
+    match in another session switches to its tab.  Matches are visited newest first: Enter
+    goes to the next one, Shift+Enter back, and Escape closes the bar.  The search is redone
+    whenever the list changes while the bar is open.
+    """
+    # most matches collected for one search
+    result_limit = 1000
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.formula_list = None
+        self.session_tabs = None
+        self.model = None
+        self.results = []
+        self.current = -1
+
+        self.line_edit = QLineEdit(self)
+        self.line_edit.setPlaceholderText(r'Find: \int, \Ex, dx, x_1 ...')
+        self.line_edit.setClearButtonEnabled(True)
+        self.line_edit.textChanged.connect(self.search)
+        self.line_edit.returnPressed.connect(self.findNext)
+        self.line_edit.installEventFilter(self)
+        self.label = QLabel(self)
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(4, 2, 4, 2)
+        layout.addWidget(self.line_edit)
+        layout.addWidget(self.label)
+        for text, tip, slot in [('▲', 'Previous match (Shift+Enter)', self.findPrevious),
+                                ('▼', 'Next match (Enter)', self.findNext),
+                                ('✕', 'Close (Esc)', self.hide)]:
+            button = QToolButton(self)
+            button.setText(text)
+            button.setToolTip(tip)
+            button.setAutoRaise(True)
+            button.clicked.connect(slot)
+            layout.addWidget(button)
+
+    def setFormulaList(self, formula_list):
+        self.formula_list = formula_list
+        self.model = None
+        self.setModel(formula_list.formula_model)
+        formula_list.formulaModelChanged.connect(self.setModel)
+
+    def setSessionTabs(self, session_tabs):
+        self.session_tabs = session_tabs
+        session_tabs.sessionClosed.connect(self.refresh)
+        self.refresh()
+
+    def setModel(self, model):
+        # the list's model changes with the session shown
+        if self.model is not None:
+            for signal in (self.model.rowsInserted, self.model.rowsRemoved, self.model.modelReset):
+                signal.disconnect(self.refresh)
+        self.model = model
+        for signal in (model.rowsInserted, model.rowsRemoved, model.modelReset):
+            signal.connect(self.refresh)
+        self.refresh()
+
+    def activate(self):
+        self.show()
+        self.line_edit.selectAll()
+        self.line_edit.setFocus()
+        self.refresh()
+
+    def refresh(self, *args):
+        if self.isVisible():
+            self.search(self.line_edit.text(), select=False)
+
+    def search(self, text:str, select=True):
+        # (session, serial) of each match; without tabs, the session is None
+        if not text.strip():
+            self.results = []
+        elif self.session_tabs is not None:
+            self.results = self.session_tabs.search(text, self.result_limit)
+        else:
+            self.results = [(None, serial) for serial in
+                            self.formula_list.formula_model.search(text, self.result_limit)]
+        self.current = -1
+        if select and self.results:
+            self.showResult(0)
+        self.updateLabel()
+
+    def findNext(self):
+        if self.results:
+            self.showResult((self.current + 1) % len(self.results))
+
+    def findPrevious(self):
+        if self.results:
+            self.showResult((self.current - 1) % len(self.results))
+
+    def showResult(self, current:int):
+        match = self.results[current]
+        session, serial = match
+        if session is not None and session is not self.session_tabs.session():
+            if session not in self.session_tabs.sessions:
+                return
+            self.session_tabs.setCurrentIndex(self.session_tabs.sessions.index(session))
+        model = self.formula_list.formula_model
+        row = model.row_of(serial)
+        # showing another session or fetching rows redoes the search, which may have put
+        # the match elsewhere
+        self.current = self.results.index(match) if match in self.results else current
+        if row >= 0:
+            index = model.index(row)
+            self.formula_list.setCurrentIndex(index)
+            self.formula_list.scrollTo(index, QAbstractItemView.PositionAtCenter)
+        self.updateLabel()
+
+    def updateLabel(self):
+        if not self.line_edit.text().strip():
+            self.label.clear()
+        elif not self.results:
+            self.label.setText('no matches')
+        else:
+            more = '+' if len(self.results) >= self.result_limit else ''
+            self.label.setText('{} of {}{}'.format(self.current + 1 if self.current >= 0 else '-',
+                                                   len(self.results), more))
+
+    def eventFilter(self, obj, event):
+        if obj is self.line_edit and event.type() == QEvent.KeyPress:
+            if event.key() == Qt.Key_Escape:
+                self.hide()
+                self.formula_list.setFocus()
+                return True
+            if event.key() in (Qt.Key_Return, Qt.Key_Enter) and event.modifiers() & Qt.ShiftModifier:
+                self.findPrevious()
+                return True
+        return super().eventFilter(obj, event)
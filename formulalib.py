@@ -0,0 +1,197 @@
+"""Read-only formula libraries: large reference collections of rendered formulas.
+
+A library is one file, written once (``mathmemo render -f library``) and then only read.
+It is opened with mmap, and opening reads nothing but the header: a formula and its svg
+are read out of the map when its row is painted or copied, so a library of any size
+opens at once and only what has been looked at takes up memory.
+
+Layout, little endian::
+
+    header   magic, version u16, count u32, index offset u64, glyphs offset u64,
+             glyphs length u64
+    blobs    each formula (utf-8) and its svg body, back to back
+    index    count entries of: formula offset u64, formula length u32, svg offset u64,
+             svg length u32, height in list rows u32
+    glyphs   the glyph elements the bodies use (see svgopt.GlyphTable)
+"""
+import mmap, os, struct
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize
+from PyQt5.QtGui import QPixmapCache
+from formulalist import FormulaModel
+from svgopt import GlyphTable, glyph_pattern, root_only
+from svgraster import formula_hash, svg_geometry
+
+library_magic = b'MMLIB\0'
+library_version = 1
+library_suffix = '.mmlib'
+header = struct.Struct('<6sHIQQQ')
+index_entry = struct.Struct('<QIQII')
+
+
+def is_library_file(filename) -> bool:
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(library_magic)) == library_magic
+    except OSError:
+        return False
+
+
+def svg_height(svg:bytes) -> int:
+    # the same as FormulaModel.entry_height
+    return svg_geometry(root_only(svg))[0].height() // 24
+
+
+class LibraryWriter:
+    """Writes a library to ``filename``, one ``add`` at a time; ``close`` finishes it."""
+
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(bytes(header.size))
+        self.index = bytearray()
+        self.count = 0
+        self.glyphs = GlyphTable()
+
+    def add(self, formula:str, svg:bytes, height=None):
+        """Add ``formula`` with its minified svg (see svgopt.minify), as rendered."""
+        body = self.glyphs.split(svg) if svg else b''
+        if height is None:
+            height = svg_height(body) if body else 0
+        formula = formula.encode()
+        formula_offset = self.file.tell()
+        self.file.write(formula)
+        self.file.write(body)
+        self.index += index_entry.pack(formula_offset, len(formula),
+                                       formula_offset + len(formula), len(body), height)
+        self.count += 1
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(self.index)
+        glyphs = b''.join(self.glyphs.glyphs.values())
+        glyphs_offset = self.file.tell()
+        self.file.write(glyphs)
+        self.file.seek(0)
+        self.file.write(header.pack(library_magic, library_version, self.count, index_offset,
+                                    glyphs_offset, len(glyphs)))
+        self.file.close()
+
+
+class FormulaLibrary:
+    """A library file opened for reading."""
+
+    def __init__(self, filename):
+        self.filename = os.fspath(filename)
+        with open(self.filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map.size() < header.size:
+            raise ValueError('{}: not a formula library'.format(self.filename))
+        magic, version, self.count, self.index_offset, glyphs_offset, glyphs_length = \
+            header.unpack_from(self.map)
+        if magic != library_magic:
+            raise ValueError('{}: not a formula library'.format(self.filename))
+        if version > library_version:
+            raise ValueError('{}: library format {} is newer than {}'.format(
+                self.filename, version, library_version))
+        self.glyphs_span = (glyphs_offset, glyphs_offset + glyphs_length)
+        self._glyphs = None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def entry(self, i:int) -> tuple:
+        return index_entry.unpack_from(self.map, self.index_offset + i * index_entry.size)
+
+    def formula(self, i:int) -> str:
+        offset, length, _, _, _ = self.entry(i)
+        return self.map[offset:offset + length].decode()
+
+    def body(self, i:int) -> bytes:
+        """The svg of formula ``i`` without its glyphs."""
+        _, _, offset, length, _ = self.entry(i)
+        return self.map[offset:offset + length]
+
+    def height(self, i:int) -> int:
+        return self.entry(i)[4]
+
+    @property
+    def glyphs(self) -> GlyphTable:
+        if self._glyphs is None:
+            start, end = self.glyphs_span
+            self._glyphs = GlyphTable({match.group(1).decode(): match.group()
+                                       for match in glyph_pattern.finditer(self.map[start:end])})
+        return self._glyphs
+
+    def svg(self, i:int) -> bytes:
+        return self.glyphs.join(self.body(i))
+
+
+class LibraryModel(QAbstractListModel):
+    """A FormulaLibrary as a read-only model, with the roles of FormulaModel, so that it
+    can be shown in a FormulaList.
+
+    Only the rows that have been painted keep anything: their pixmap key and geometry.
+    """
+    SvgRole = FormulaModel.SvgRole
+    FormulaRole = FormulaModel.FormulaRole
+    KeyRole = FormulaModel.KeyRole
+    GeometryRole = FormulaModel.GeometryRole
+    BodyRole = FormulaModel.BodyRole
+
+    def __init__(self, library, parent=None):
+        super().__init__(parent)
+        self.library = library
+        self.keys = {}
+        self.geometries = {}
+        self.pixmap_keys = set()
+        # a FormulaList expects these of its model; nothing is ever added to a library
+        self.queue = []
+        self.journal = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.library)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = index.row()
+        if role == self.FormulaRole or role == Qt.ToolTipRole:
+            return self.library.formula(row)
+        elif role == self.SvgRole:
+            return self.library.svg(row)
+        elif role == self.BodyRole:
+            return self.library.body(row)
+        elif role == self.KeyRole:
+            if row not in self.keys:
+                self.keys[row] = formula_hash(self.library.body(row))
+            return self.keys[row]
+        elif role == self.GeometryRole:
+            if row not in self.geometries:
+                self.geometries[row] = svg_geometry(root_only(self.library.body(row)))
+            return self.geometries[row]
+        elif role == Qt.SizeHintRole:
+            height = self.library.height(row)
+            if not height:
+                height = self.data(index, self.GeometryRole)[0].height() // 24
+            return QSize(0, height)
+        return None
+
+    def isModified(self):
+        return False
+
+    def release(self):
+        for cache_key in self.pixmap_keys:
+            QPixmapCache.remove(cache_key)
+        self.pixmap_keys = set()
+        self.keys = {}
+        self.geometries = {}
+
+    def close(self):
+        self.beginResetModel()
+        self.release()
+        self.library.close()
+        self.library = ()
+        self.endResetModel()
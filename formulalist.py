@@ -1,48 +1,436 @@
-import logging, sys
-from PyQt5.QtWidgets import qApp, QListWidget, QLabel, QSizePolicy, QAbstractItemView, QListWidgetItem, QMenu
-from PyQt5.QtCore import Qt, QSize, QMimeData, QUrl, QMutex, QMutexLocker, pyqtSignal
-from PyQt5.QtGui import QPalette, QCursor, QImage, QPainter
-from PyQt5.QtSvg import QSvgWidget, QSvgRenderer
-from PyQt5.QtWebEngineWidgets import QWebEnginePage
-from mjrender import (context, mathjax_v2_url, mathjax_url_remote, mathjax_url, mathjax_v2_config,
-                      mathjax_config, page_template)
-from io import BytesIO
-
-
-def render_latex_as_svg(latex_formula):
-    fig, ax = plt.subplots()
-    ax.text(0.5, 0.5, fr'${latex_formula}$', size=30, ha='center', va='center')
-    # ax.text(0.5, 0.5, fr'[{latex_formula}]', size=30, ha='center', va='center')
-    ax.set_axis_off()
-    buffer = BytesIO()
-    plt.savefig(buffer, format='svg')
-    svg_image = buffer.getvalue()
-    buffer.close()
-    plt.close(fig)
-    return svg_image
-
-class FormulaList(QListWidget):
+import logging, os
+from bisect import bisect_left
+from functools import partial
+from PyQt5.QtWidgets import (qApp, QListView, QAbstractItemView, QMenu, QStyledItemDelegate,
+                             QStyle)
+from PyQt5.QtCore import (Qt, QSize, QPointF, QMimeData, QMutex, QMutexLocker, pyqtSignal,
+                          QAbstractListModel, QModelIndex)
+from PyQt5.QtGui import QCursor, QPixmapCache
+from session import SessionStore, is_session_file, parse_text_session, session_suffix
+from svgraster import (formula_hash, svg_geometry, padded_size, svg_pixmap, svg_image, pixmap_key,
+                       list_padding)
+from svgopt import GlyphTable, minify, root_only
+from searchindex import SearchIndex
+from texnormalize import canonical
+
+
+class FormulaEntry:
+    __slots__ = ('formula', 'svg', 'key', 'geometry', 'height', 'id', 'serial', 'canonical')
+
+    def __init__(self, formula, svg:bytes, height=None, id=None, serial=None, canonical=None):
+        self.formula = formula
+        self.svg = svg
+        self.key = None
+        self.geometry = None
+        # row height in the list, kept in the session so layout doesn't need the svg
+        self.height = height
+        # row id in the session store, None until the entry has been saved
+        self.id = id
+        # increases down the list and never changes; the entry's key in the search index
+        self.serial = serial
+        # texnormalize.canonical of the formula, worked out when first needed
+        self.canonical = canonical
+
+
+class FormulaModel(QAbstractListModel):
+    """The formulas in a FormulaList along with their rendered SVGs.
+
+    Rows hold nothing but the formula source and the SVG bytes; they are only turned into
+    anything drawable by FormulaDelegate when they are actually painted.  The svgs are kept
+    without their glyphs, which the rows share through the model's GlyphTable; SvgRole
+    gives the complete, standalone svg.  Rows whose formulas have the same canonical key
+    (see texnormalize) share one svg, in memory and in the session file.
+
+    A model opened from a SessionStore fetches its rows in pages as the view scrolls, and
+    reads each row's svg from the store the first time it is needed.  ``save`` then only
+    writes the rows added and removed since the last save.
+
+    ``search`` finds rows through a SearchIndex over every formula in the model, including
+    rows not fetched yet.  The index can be shared with other sessions (see SessionTabs),
+    each keeping its rows under keys of its own.  A model's rows are added to the index the
+    first time it is searched and then kept up to date as rows are added and removed.
+    """
     SvgRole = Qt.UserRole
     FormulaRole = Qt.UserRole + 1
+    KeyRole = Qt.UserRole + 2
+    GeometryRole = Qt.UserRole + 3
+    # the svg without its glyphs
+    BodyRole = Qt.UserRole + 4
+
+    # number of rows read from the session store at a time
+    fetch_size = 1000
+    # height of a row whose formula failed to render and so has no svg
+    empty_height = 24
+    # a key in the search index is the session's number above this many bits of row serial
+    index_bits = 40
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+        self.store = None
+        self.more = False
+        self.last_id = 0
+        self.deleted_ids = []
+        self.glyphs = GlyphTable()
+        # the SearchIndex this model's rows are kept in, and whether they are in it yet
+        self.formula_index = None
+        self.index_number = 0
+        self.indexed = False
+        # canonical key -> [svg shared by the rows with that key, number of rows]
+        self.shared = {}
+        # [formula, svg] slots of formulas being rendered for the end of the list, in order
+        self.queue = []
+        # pixmap cache keys of the rows painted, so they can be released
+        self.pixmap_keys = set()
+        # autosave journal the changes are written to as they are made (see journal)
+        self.journal = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        entry = self.entries[index.row()]
+        if role == self.FormulaRole or role == Qt.ToolTipRole:
+            return entry.formula
+        elif role == self.SvgRole:
+            return self.glyphs.join(self.entry_svg(entry))
+        elif role == self.BodyRole:
+            return self.entry_svg(entry)
+        elif role == self.KeyRole:
+            if entry.key is None:
+                entry.key = formula_hash(self.entry_svg(entry))
+            return entry.key
+        elif role == self.GeometryRole:
+            if entry.geometry is None:
+                # parsed once per row, the first time it is painted
+                entry.geometry = svg_geometry(root_only(self.entry_svg(entry)))
+            return entry.geometry
+        elif role == Qt.SizeHintRole:
+            return QSize(0, self.entry_height(entry))
+        return None
+
+    def entry_svg(self, entry):
+        # the svg without its glyphs, which is all that the key and geometry depend on
+        if entry.svg is None and entry.id is not None and self.store is not None:
+            svg = self.store.svg(entry.id)
+            # svgs from version 1 sessions still have their glyphs
+            entry.svg = self.share(entry, self.glyphs.split(minify(svg))) if svg else svg
+        return entry.svg
+
+    def entry_canonical(self, entry):
+        if entry.canonical is None:
+            entry.canonical = canonical(entry.formula)
+        return entry.canonical
+
+    def share(self, entry, svg:bytes) -> bytes:
+        """Return the svg ``entry`` shares with the other rows with its canonical key."""
+        if not svg:
+            return svg
+        shared = self.shared.setdefault(self.entry_canonical(entry), [svg, 0])
+        shared[1] += 1
+        return shared[0]
+
+    def unshare(self, entry):
+        shared = self.shared.get(entry.canonical)
+        if entry.svg and shared is not None:
+            shared[1] -= 1
+            if shared[1] <= 0:
+                del self.shared[entry.canonical]
+
+    def entry_height(self, entry):
+        if entry.height is None:
+            if not self.entry_svg(entry):
+                return self.empty_height
+            if entry.geometry is None:
+                entry.geometry = svg_geometry(root_only(self.entry_svg(entry)))
+            entry.height = entry.geometry[0].height() // 24
+        return entry.height
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.more
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+
+        rows = self.store.rows(self.last_id, self.fetch_size)
+        self.more = len(rows) == self.fetch_size
+        if rows:
+            self.last_id = rows[-1][0]
+            row = len(self.entries)
+            self.beginInsertRows(QModelIndex(), row, row + len(rows) - 1)
+            # stored rows are keyed by their id, which also increases down the list
+            self.entries.extend(FormulaEntry(formula, None, height, entry_id, entry_id, key)
+                                for entry_id, formula, height, key in rows)
+            self.endInsertRows()
+
+    def fetch_all(self):
+        while self.canFetchMore():
+            self.fetchMore()
+
+    def open_store(self, store):
+        self.beginResetModel()
+        if self.store is not None:
+            self.store.close()
+        self.entries = []
+        self.store = store
+        self.more = True
+        self.last_id = 0
+        self.deleted_ids = []
+        self.glyphs = GlyphTable(store.glyphs())
+        self.unindex()
+        self.shared = {}
+        self.endResetModel()
+        logging.debug('{}: {} formulas'.format(store.filename, store.count()))
+
+    def isModified(self):
+        # new rows are only ever added at the end
+        return bool(self.deleted_ids) or bool(self.entries and self.entries[-1].id is None)
+
+    def save(self, filename, context=None):
+        filename = os.fspath(filename)
+        if self.store is None:
+            self.store = SessionStore.create(filename)
+        elif os.path.abspath(filename) != os.path.abspath(self.store.filename):
+            # save as: the old file is left exactly as it was last saved
+            store = self.store.copy_to(filename)
+            self.store.close()
+            self.store = store
+
+        # only what changed since the last save is written
+        self.store.delete(self.deleted_ids)
+        new_entries = [entry for entry in self.entries if entry.id is None]
+        ids = self.store.append([(entry.formula, entry.svg, self.entry_height(entry),
+                                  self.entry_canonical(entry)) for entry in new_entries], context)
+        self.store.add_glyphs(self.glyphs.glyphs)
+        self.store.commit()
+
+        for entry, entry_id in zip(new_entries, ids):
+            entry.id = entry_id
+        self.last_id = max(ids, default=self.last_id)
+        self.deleted_ids = []
+
+    def append_formulas(self, formulas, svgs):
+        entries = [FormulaEntry(formula, None) for formula in formulas]
+        for entry, svg in zip(entries, svgs):
+            entry.svg = self.share(entry, self.glyphs.split(svg))
+        # new rows go after everything in the session, including rows not read in yet
+        self.fetch_all()
+        serial = max((entry.serial for entry in self.entries[-1:]), default=0)
+        for serial, entry in enumerate(entries, serial + 1):
+            entry.serial = serial
+        if self.indexed:
+            self.formula_index.add_many((self.index_key(entry.serial), entry.formula)
+                                        for entry in entries)
+        if entries:
+            row = len(self.entries)
+            self.beginInsertRows(QModelIndex(), row, row + len(entries) - 1)
+            self.entries.extend(entries)
+            self.endInsertRows()
+            if self.journal is not None:
+                self.journal.add(formulas, svgs)
+
+    def index_key(self, serial:int) -> int:
+        return self.index_number << self.index_bits | serial
+
+    @classmethod
+    def split_index_key(cls, key:int) -> tuple:
+        """The session number and row serial in search index ``key``."""
+        return key >> cls.index_bits, key & ((1 << cls.index_bits) - 1)
+
+    def share_index(self, index, number:int):
+        """Keep the rows in ``index``, shared with other sessions, under keys made with
+        ``number``, which no other session in it uses."""
+        self.unindex()
+        self.formula_index = index
+        self.index_number = number
+
+    def search_index(self):
+        if self.formula_index is None:
+            self.formula_index = SearchIndex()
+        if not self.indexed:
+            self.formula_index.add_many((self.index_key(entry.serial), entry.formula)
+                                        for entry in self.entries)
+            # rows not fetched yet are read from the store without fetching them
+            last_id = self.last_id
+            while self.more:
+                rows = self.store.rows(last_id, self.fetch_size)
+                if not rows:
+                    break
+                self.formula_index.add_many((self.index_key(row[0]), row[1]) for row in rows)
+                last_id = rows[-1][0]
+            self.indexed = True
+            logging.debug('search index: {} formulas'.format(len(self.formula_index)))
+        return self.formula_index
+
+    def unindex(self):
+        """Take the rows out of the search index, e.g. when the session is closed."""
+        if self.indexed:
+            for key in [key for key in self.formula_index.formulas
+                        if self.split_index_key(key)[0] == self.index_number]:
+                self.formula_index.remove(key)
+            self.indexed = False
+
+    def search(self, query:str, limit=None) -> list:
+        """Return the serials of the rows matching ``query``, last row first."""
+        found = []
+        for key in self.search_index().search(query):
+            number, serial = self.split_index_key(key)
+            # a shared index has the other sessions' rows too
+            if number == self.index_number:
+                found.append(serial)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def row_of(self, serial:int) -> int:
+        """The row of the entry with ``serial``, fetching rows up to it; -1 if it's gone."""
+        while self.canFetchMore() and (not self.entries or self.entries[-1].serial < serial):
+            self.fetchMore()
+        row = bisect_left(self.entries, serial, key=lambda entry: entry.serial)
+        return row if row < len(self.entries) and self.entries[row].serial == serial else -1
+
+    def release(self):
+        """Drop whatever can be had again: the rows' pixmaps, their parsed geometry, svgs that
+        can be read back from the session store.  A session with nothing unsaved lets go
+        of its rows as well.  The rows stay in the search index, so a search still finds
+        them.
+        """
+        for cache_key in self.pixmap_keys:
+            QPixmapCache.remove(cache_key)
+        self.pixmap_keys = set()
+        if self.store is not None and not self.isModified() and not self.queue:
+            # everything is in the store, so the rows themselves can be read in again
+            if self.indexed:
+                # rows read back have their store id as serial, which rows added since the
+                # session was opened weren't indexed under
+                moved = [entry for entry in self.entries if entry.serial != entry.id]
+                for entry in moved:
+                    self.formula_index.remove(self.index_key(entry.serial))
+                self.formula_index.add_many((self.index_key(entry.id), entry.formula)
+                                            for entry in moved)
+            self.beginResetModel()
+            self.entries = []
+            self.shared = {}
+            self.more = True
+            self.last_id = 0
+            self.endResetModel()
+            return
+        for entry in self.entries:
+            entry.key = None
+            entry.geometry = None
+            if entry.id is not None and entry.svg is not None:
+                self.unshare(entry)
+                entry.svg = None
+
+    def canonical_row(self, key:str) -> int:
+        """The last row whose formula has canonical ``key``, or -1."""
+        self.fetch_all()
+        for row in range(len(self.entries) - 1, -1, -1):
+            if self.entry_canonical(self.entries[row]) == key:
+                return row
+        return -1
+
+    def canonicals(self) -> set:
+        self.fetch_all()
+        return {self.entry_canonical(entry) for entry in self.entries}
+
+    def removeRows(self, row, count, parent=QModelIndex()):
+        if parent.isValid() or row < 0 or count <= 0 or row + count > len(self.entries):
+            return False
+
+        self.beginRemoveRows(QModelIndex(), row, row + count - 1)
+        self.deleted_ids.extend(entry.id for entry in self.entries[row:row + count]
+                                if entry.id is not None)
+        for entry in self.entries[row:row + count]:
+            self.unshare(entry)
+            if self.indexed:
+                self.formula_index.remove(self.index_key(entry.serial))
+        del self.entries[row:row + count]
+        self.endRemoveRows()
+        if self.journal is not None:
+            self.journal.delete(row, count)
+        return True
+
+
+class FormulaDelegate(QStyledItemDelegate):
+    """Paints a row's SVG from the model, only for rows that are visible.
+
+    Formulas are rasterized through the shared pixmap cache, so scrolling back over rows
+    that were already drawn just blits the cached pixmaps.
+    """
+
+    def paint(self, painter, option, index):
+        # let the style draw the background and selection, then the formula on top
+        self.initStyleOption(option, index)
+        option.text = ''
+        style = option.widget.style() if option.widget else qApp.style()
+        style.drawControl(QStyle.CE_ItemViewItem, option, painter, option.widget)
+
+        if not index.data(FormulaModel.BodyRole):
+            return
+
+        rect = option.rect
+        natural = padded_size(index.data(FormulaModel.GeometryRole), list_padding)
+        if natural.isEmpty():
+            return
+        scale = round(min(rect.height() / natural.height(), rect.width() / natural.width()), 3)
+        dpr = painter.device().devicePixelRatioF()
+        # the standalone svg is only put together when the pixmap isn't cached
+        key = index.data(FormulaModel.KeyRole)
+        pixmap = svg_pixmap(partial(index.data, FormulaModel.SvgRole), key, 'black', scale, dpr,
+                            padding=list_padding)
+        index.model().pixmap_keys.add(pixmap_key(key, 'black', scale, dpr, padding=list_padding))
+
+        size = pixmap.size() / dpr
+        painter.drawPixmap(QPointF(rect.x() + (rect.width() - size.width()) / 2,
+                                   rect.y() + (rect.height() - size.height()) / 2), pixmap)
+
+    def sizeHint(self, option, index):
+        return index.data(Qt.SizeHintRole)
+
+
+class FormulaList(QListView):
+    """Shows a FormulaModel, and adds formulas to it through the RenderService.
+
+    The model can be swapped with ``setFormulaModel``, e.g. one per open session.  Formulas
+    still being rendered when that happens are added to the model they were meant for.
+    """
+    formulaModelChanged = pyqtSignal(object)
+    SvgRole = FormulaModel.SvgRole
+    FormulaRole = FormulaModel.FormulaRole
+
+    # number of formulas sent to the renderer per round trip when loading a session
+    batch_size = 64
+    # adding a formula equivalent to one already in the list (see texnormalize) doesn't add
+    # a row; the existing row is selected instead
+    collapse_duplicates = False
 
     def __init__(self, parent=None, formulas=[]):
         super().__init__(parent)
-        self.formula_queue = []
         self.formula_queue_mutex= QMutex()
         self.clipboard = qApp.clipboard()
 
-        self.setVerticalScrollMode(QListWidget.ScrollMode.ScrollPerPixel)
+        self.formula_model = FormulaModel(self)
+        self.setModel(self.formula_model)
+        self.setItemDelegate(FormulaDelegate(self))
+
+        self.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
         self.setUniformItemSizes(False)
+        # rows are laid out a chunk at a time, so huge sessions don't stall the first paint
+        self.setLayoutMode(QListView.Batched)
         self.setSelectionMode(QAbstractItemView.SingleSelection)
         self.setSpacing(1)
 
-        self.setViewMode(QListWidget.ListMode)
-        self.formula_page = QWebEnginePage()
-        self.formula_page.loadFinished.connect(self._on_load_finished)
+        self.setViewMode(QListView.ListMode)
+        self._render_service = None
 
         for formula in formulas:
             self.append_formula(formula)
-        self.setStyleSheet("QListWidget"
+        self.setStyleSheet("QListView"
                                   "{"
                                   "background : white;"
                                   "}"
@@ -55,47 +443,38 @@ class FormulaList(QListWidget):
 
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.listContextMenuReuquested)
-        self.itemSelectionChanged.connect(self.itemChanged)
         self.copyDefault = self.copyEquation
 
-    def itemChanged(self):
-
-        for item in [self.item(i) for i in range(self.count())]:
-            svg_widget = self.itemWidget(item)
-            if item.isSelected():
-                #item.setBackgroundColor(Qt.green)
-                #svg_widget.setStyleSheet("QSvgWidget { background: cyan; }")
-                #svg_widget.setAutoFillBackground(True)
-                #pal = QPalette(svg_widget.palette())
-                # svg_widget.palette().Background.setColor(QColor('cyan'))
-                #pal.setColor(QPalette.Background, QColor('cyan'))
-                # svg_widget.setPalette(pal)
-                # pal = QPalette()
-
-                #svg_widget.setBackgroundRole(QPalette.Highlight)
-                #svg_widget.setForegroundRole(QPalette.HighlightedText)
-                ...
-
-            else:
-                # svg_widget.setStyleSheet("QSvgWidget { background: white; }")
-                #svg_widget.setForegroundRole(QPalette.BrightText)
-                #svg_widget.setBackgroundRole(QPalette.Base)
-                ...
-
-        # order: [group]role
-        #c = pal.color(QPalette.Window, QPalette.Highlight)
-        # c = pal.color(QPalette.Highlight)
-        # print('color: ', c)
-        # print('color: ', QPalette.Highlight)
-        logging.debug('type h: {}'.format(type(QPalette.Highlight)))
-        logging.debug('type w: {}'.format(type(QPalette.WindowText)))
-        #print('type: ', type(QPalette.Highlight))
-        # QPalette.Highlight
-        # QPalette.HighlightedText
-        #pal = QPalette(svg_widget.palette())
-        #pal.setColor(QPalette.Window, QColor('red'))
-        #svg_widget.setPalette(pal)
-        #svg_widget.setAutoFillBackground(True)
+    def setRenderService(self, service):
+        self._render_service = service
+
+    @property
+    def render_service(self):
+        # normally the application's service is set; a list on its own gets a private one
+        if self._render_service is None:
+            from renderservice import RenderService
+            self._render_service = RenderService(parent=self)
+        return self._render_service
+
+    @property
+    def formula_queue(self):
+        return self.formula_model.queue
+
+    def setFormulaModel(self, model):
+        if model is self.formula_model:
+            return
+        self.formula_model = model
+        self.setModel(model)
+        self.formulaModelChanged.emit(model)
+
+    def setCollapseDuplicates(self, collapse:bool):
+        self.collapse_duplicates = collapse
+
+    def count(self):
+        return self.formula_model.rowCount()
+
+    def formula_data(self, row, role):
+        return self.formula_model.data(self.formula_model.index(row), role)
 
     def listContextMenuReuquested(self, pos):
         print('context menu requested')
@@ -134,12 +513,10 @@ class FormulaList(QListWidget):
 
     def copySvg(self, index):
 
-        item = self.item(index)
-        svg = item.data(self.SvgRole)
+        svg = self.formula_data(index, self.SvgRole)
 
         # create a QMimeData object and set the SVG data
         mime_data = QMimeData()
-        print("copySVG: image type: ", type(self.itemWidget(item)))
         # mime_data.setData("image/svg+xml", self.images[index])
         mime_data.setData("image/svg", svg.replace(b'currentColor', b'red')) # works for Anki
 
@@ -155,8 +532,7 @@ class FormulaList(QListWidget):
 
     def copySvgText(self, index):
 
-        item = self.item(index)
-        svg = item.data(self.SvgRole)
+        svg = self.formula_data(index, self.SvgRole)
         qApp.clipboard().setText(svg.decode())
 
 
@@ -164,18 +540,10 @@ class FormulaList(QListWidget):
         # FIX: Try scaling down the image size to see if Anki likes that
         # more.  Mozilla seems to be fine with it tho
 
-        item = self.item(index)
-        svg = item.data(self.SvgRole)
-
-        renderer = QSvgRenderer()
-        renderer.load(svg.replace(b'currentColor', b'black'))
+        svg = self.formula_data(index, self.SvgRole)
 
-        image = QImage(renderer.defaultSize(), QImage.Format_ARGB32)
-        #image.fill(0x00000000)  # fill the image with transparent pixels
-        image.fill(Qt.white)
-        painter = QPainter(image)
-        renderer.render(painter)
-        painter.end()
+        # rasterized through the pixmap cache, so copying the same formula again is free
+        image = svg_image(svg, self.formula_data(index, FormulaModel.KeyRole), 'black')
 
         # Copy image to clipboard
         self.clipboard.setImage(image)
@@ -183,8 +551,7 @@ class FormulaList(QListWidget):
 
     def copyEquation(self, index):
 
-        item = self.item(index)
-        formula = item.data(self.FormulaRole)
+        formula = self.formula_data(index, self.FormulaRole)
 
         qApp.clipboard().setText(formula)
 
@@ -207,107 +574,135 @@ class FormulaList(QListWidget):
     def deleteEquation(self, index):
         # self.formulas.pop(index)
         # self.images.pop(index)
-        self.takeItem(index)
-
-    def append_formula_svg_matplotlib(self, formula):
-        # self.formulas.append(formula)
-        svg = QSvgWidget()
-        svg_data = render_latex_as_svg(formula)
-        svg.load(svg_data)
-        svg.renderer().setAspectRatioMode(Qt.KeepAspectRatio)
-        # svg.sizeHint() returns (460, 345)
-        self.layout().addWidget(svg)
-
-    def append_formula_svg(self, formula, svg:bytes):
-
-        item = QListWidgetItem()
-        item.setData(self.FormulaRole, formula)
-        item.setData(self.SvgRole, svg)
-
-        # self.formulas.append(formula)
-        # self.images.append(svg)
-        svg_widget = QSvgWidget()
-
-        # This can replace the color in the svg data
-        # svg = svg.replace(b'currentColor', b'red')
+        self.formula_model.removeRows(index, 1)
 
-        svg_widget.load(svg)
-        svg_widget.renderer().setAspectRatioMode(Qt.KeepAspectRatio)
-        svg_widget.renderer().setViewBox(svg_widget.renderer().viewBox().adjusted(0, -200, 0, 200))
-        svg_widget.setFixedHeight( svg_widget.renderer().defaultSize().height() // 24)
+    def append_formula_svg(self, formula, svg:bytes, model=None):
+        self.append_formula_svgs([formula], [svg], model)
 
-        # effectively adds padding around the QSvgWidget
-        print("view box: ", svg_widget.renderer().viewBox())
+    def append_formula_svgs(self, formulas, svgs, model=None):
+        model = model or self.formula_model
+        # one model update per batch; nothing is drawn until a row scrolls into view
+        model.append_formulas(formulas, svgs)
+        if model is self.formula_model:
+            self.scrollToBottom()
 
-        print("sfh resized: ", svg_widget.renderer().defaultSize().height())
-        policy = QSizePolicy()
-        policy.setVerticalPolicy(QSizePolicy.Fixed)
-
-        print('svg sizeHint: ', svg_widget.sizeHint())
-
-        print('svg_widegt size hint: ', svg_widget.sizeHint())
-        # item.setContentsMargins(0, 5, 0, 5)  #no effect?
-        item.setSizeHint(QSize(0, svg_widget.renderer().defaultSize().height() // 24))
-
-        self.addItem(item)
-        self.setItemWidget(item, svg_widget)
-
-        self.scrollToBottom()
-
-
-    def _on_load_finished(self):
-        # Extract the SVG output from the page and add an XML header
-        xml_header = b'<?xml version="1.0" encoding="utf-8" standalone="no"?>'
-        self.formula_page.runJavaScript("""
-            var mjelement = document.getElementById('mathjax-container');
-            mjelement.getElementsByTagName('svg')[0].outerHTML;
-        """, lambda result: self.update_svg(xml_header + result.encode()))
-        # print('olf svg: ', self.formula_svg)
+    def update_svg(self, model, entry, svg:bytes):
+        with QMutexLocker(self.formula_queue_mutex):
+            entry[1] = svg
+            self.flush_formula_queue(model)
 
-    def update_svg(self, svg:bytes):
+    def update_svgs(self, model, entries, svgs:list):
         with QMutexLocker(self.formula_queue_mutex):
-            formula = self.formula_queue.pop(0)
-            self.append_formula_svg(formula, svg)
-            if len(self.formula_queue) > 0:
-                formula = self.formula_queue[0]
-                self.formula_page.setHtml(page_template.format(formula=formula), QUrl('file://'))
+            for entry, svg in zip(entries, svgs):
+                entry[1] = svg
+            self.flush_formula_queue(model)
+
+    def flush_formula_queue(self, model=None):
+        # pages in the pool finish in any order, so each queue entry is a [formula, svg]
+        # slot that gets filled in when its result arrives.  Only the finished run at the
+        # head of the queue is added, which keeps the list in submission order.
+        model = model or self.formula_model
+        queue = model.queue
+        done = 0
+        while done < len(queue) and queue[done][1] is not None:
+            done += 1
+        finished = queue[:done]
+        del queue[:done]
+
+        if len(finished) == 1:
+            self.append_formula_svg(*finished[0], model)
+        elif finished:
+            self.append_formula_svgs(*zip(*finished), model)
+
+    def save(self, filename):
+        if os.fspath(filename).endswith(session_suffix):
+            self.save_session(filename)
+        else:
+            self.save_as_text(filename)
+
+    def open(self, filename):
+        if is_session_file(filename):
+            self.load_session(filename)
+        else:
+            self.load_from_text(filename)
+
+    def save_session(self, filename):
+        self.formula_model.save(filename, self.render_service.cache.context_hash)
+
+    def load_session(self, filename):
+        print('opening session: ', filename)
+        self.formula_model.open_store(SessionStore(filename))
 
     def save_as_text(self, filename):
+        self.formula_model.fetch_all()
         with open(filename, 'wt') as f:
-            for item in [self.item(i) for i in range(self.count())]:
-                formula = item.data(self.FormulaRole)
+            for row in range(self.count()):
+                formula = self.formula_data(row, self.FormulaRole)
                 f.write('\[' + formula + '\]\n')
 
     def load_from_text(self, filename):
         print('opening: ', filename)
         with open(filename, 'rt') as f:
-            formula_list = f.read().split('\]\n\[')
+            formula_list = parse_text_session(f.read())
             print('equations: ', len(formula_list))
-            if len(formula_list) > 0:
-                formula_list[0] = formula_list[0].removeprefix('\[')
-                formula_list[-1] = formula_list[-1].removesuffix('\]\n')
-        for formula in formula_list:
-            # FIXME should we clear this first? or do we append to what is currently loaded?
-            self.append_formula(formula)
-            print('calling append: ', formula)
-
-    def append_formula(self, formula:str):
+        # FIXME should we clear this first? or do we append to what is currently loaded?
+        self.append_formulas(formula_list)
+
+    def is_duplicate(self, key:str) -> bool:
+        row = self.formula_model.canonical_row(key)
+        if row >= 0:
+            index = self.formula_model.index(row)
+            self.setCurrentIndex(index)
+            self.scrollTo(index)
+            return True
+        # or still being rendered
+        return any(canonical(formula) == key for formula, _ in self.formula_queue)
+
+    def append_formula(self, formula:str, svg:bytes=None):
+        # ``svg`` is one already rendered, from a library for instance; it still waits its
+        # turn behind the formulas being rendered
+        if formula and self.collapse_duplicates and self.is_duplicate(canonical(formula)):
+            return
         if formula:
             print('appending formula: acquiring mutex', formula)
             with QMutexLocker(self.formula_queue_mutex):
                 # a mutex might be overkill here, since we don't have any explicit threads
                 # so really we should never hang up here waiting for it.
                 print('locked formula_queue_mutex')
-                self.formula_queue.append(formula)
-                if len(self.formula_queue) == 1:
-                    # page loadFinished processing is not guaranteed to complete before a new page
-                    # is called, so we only call setHtml here to kick off the processing if it
-                    # if the formula at this scope is the only one waiting in the queue.  Otherwise
-                    # update_svg will kick off the next one after the previous one is finished
-                    # processing .
-                    self.formula_page.setHtml(page_template.format(formula=formula), QUrl('file://'))
-                else:
-                    print('formula_queue processing elsewhere, moving on')
-
-
-
+                entry = [formula, svg if svg is not None else self.render_service.cached(formula)]
+                self.formula_queue.append(entry)
+                if entry[1] is not None:
+                    # cache hit, no rendering needed.  It may still have to wait behind
+                    # formulas that are being rendered.
+                    self.flush_formula_queue()
+                    return
+            # MathJax stays loaded in the service's pages, so there is no page to reload here;
+            # the formula is typeset directly and update_svg is called back with the result.
+            self.render_service.submit(formula, partial(self.update_svg, self.formula_model, entry))
+
+    def append_formulas(self, formulas:list):
+        if self.collapse_duplicates:
+            present = self.formula_model.canonicals()
+            present.update(canonical(formula) for formula, _ in self.formula_queue)
+            unique = []
+            for formula in formulas:
+                key = canonical(formula) if formula else None
+                if key not in present:
+                    present.add(key)
+                    unique.append(formula)
+            formulas = unique
+        entries = [[formula, self.render_service.cached(formula)] for formula in formulas if formula]
+        with QMutexLocker(self.formula_queue_mutex):
+            self.formula_queue.extend(entries)
+            self.flush_formula_queue()
+
+        # only cache misses go to the renderer
+        entries = [entry for entry in entries if entry[1] is None]
+        # small loads are still split so that every page in the pool gets a share
+        if not entries:
+            return
+        size = max(1, min(self.batch_size, -(-len(entries) // self.render_service.size)))
+        for start in range(0, len(entries), size):
+            batch = entries[start:start + size]
+            self.render_service.submit_batch([formula for formula, _ in batch],
+                                             partial(self.update_svgs, self.formula_model, batch))
@@ -0,0 +1,53 @@
+"""Single-instance support, client side.
+
+The first GUI launch listens on a local socket (see instanceserver).  Later launches send
+their arguments over that socket and exit, and the running instance opens the files,
+adds the formulas and raises its window.  This module only uses the standard library so
+a summon doesn't pay for importing Qt.
+"""
+import errno, json, os, socket, sys
+
+# arguments that mean this launch has to run by itself
+standalone_arguments = {'render', 'bench', '-h', '--help', '--new-instance', '--startup-times'}
+
+
+def socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(runtime_dir, 'mathmemo-{}.sock'.format(os.getuid()))
+
+
+def make_request(files, stdin=sys.stdin):
+    """The request for opening ``files``; a ``-`` among them reads formulas from stdin,
+    one per line."""
+    files = [f for f in files if f == '-' or not f.startswith('-')]
+    request = {'files': [os.path.abspath(f) for f in files if f != '-'], 'formulas': []}
+    if '-' in files:
+        request['formulas'] = [line.strip() for line in stdin if line.strip()]
+    return request
+
+
+def is_stale(path=None) -> bool:
+    """Whether the socket at ``path`` is left over from an instance that is gone, i.e.
+    connecting to it is refused or there is nothing there."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path or socket_path())
+        return False
+    except OSError as error:
+        return error.errno in (errno.ECONNREFUSED, errno.ENOENT)
+
+
+def forward(argv, path=None, timeout=5.0):
+    """Hand ``argv`` to a running instance.  Returns False if there is none, or if these
+    arguments need a process of their own."""
+    if standalone_arguments.intersection(argv):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path or socket_path())
+            # read stdin only once we know somebody is listening
+            sock.sendall(json.dumps(make_request(argv)).encode() + b'\n')
+            return sock.makefile('rb').readline().strip() == b'ok'
+    except OSError:
+        return False
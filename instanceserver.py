@@ -0,0 +1,51 @@
+"""Single-instance support, server side: requests from later launches of the GUI."""
+import json, logging
+from functools import partial
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtNetwork import QLocalServer
+from instance import is_stale, socket_path
+
+
+class InstanceServer(QObject):
+    """Accepts requests from later launches and emits them as ``requested``."""
+    requested = pyqtSignal(dict)
+
+    def __init__(self, path=None, parent=None):
+        super().__init__(parent)
+        self.path = path or socket_path()
+        self.server = QLocalServer(self)
+        self.server.newConnection.connect(self._on_new_connection)
+
+    def listen(self):
+        if not is_stale(self.path):
+            # another instance is running; its socket stays where later launches find it
+            logging.warning('another instance is listening on %s', self.path)
+            return False
+        # left over from a crash
+        QLocalServer.removeServer(self.path)
+        if not self.server.listen(self.path):
+            logging.warning('single instance socket unavailable: %s', self.server.errorString())
+            return False
+        return True
+
+    def close(self):
+        self.server.close()
+
+    def _on_new_connection(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            connection.readyRead.connect(partial(self._on_ready_read, connection))
+            connection.disconnected.connect(connection.deleteLater)
+
+    def _on_ready_read(self, connection):
+        while connection.canReadLine():
+            line = bytes(connection.readLine())
+            try:
+                request = json.loads(line)
+            except ValueError:
+                logging.warning('bad request from another instance: %r', line)
+                continue
+            # the launch waiting on this can exit now; opening files may take a while
+            connection.write(b'ok\n')
+            connection.flush()
+            QTimer.singleShot(0, partial(self.requested.emit, request))
@@ -0,0 +1,279 @@
+"""Autosave: an append-only journal of the changes made to each open session.
+
+Every formula added to or deleted from a FormulaModel is written to the session's journal
+as it happens, so the cost of autosaving is that of the change and not of the session.
+A journal is a text file of records, one per line, each line being the CRC-32 of its JSON
+in hex and the JSON itself:
+
+    {"op": "session", "filename": "/path/to/notes.mathmemo"}    always first
+    {"op": "add", "formulas": [...], "svgs": [...]}              appended at the end
+    {"op": "delete", "row": 12, "count": 1}
+
+Records go to the operating system as they are written and are fsynced in batches, at
+most every ``sync_interval`` seconds.  A session that has a file is compacted into it from
+time to time by saving it, which only writes what changed (see SessionStore), after which
+its journal starts over.  Untitled sessions have nothing to compact into, so their journal
+keeps every change until they are saved.
+
+Journals live in ``autosave_dir`` and are removed when their session is saved and closed,
+or its changes are discarded.  One left behind by a crash is replayed on the next start:
+the session file as it was last saved (or nothing, if untitled) plus the journal's
+records, up to the first one that didn't get written completely.
+"""
+import json, logging, os, uuid, zlib
+from PyQt5.QtCore import QObject, QTimer
+
+try:
+    import fcntl
+except ImportError:
+    # no locking; two instances at once could then recover each other's journals
+    fcntl = None
+
+journal_suffix = '.journal'
+
+
+def autosave_dir():
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+    return os.path.join(state_home, 'mathmemo', 'autosave')
+
+
+def _lock(f) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class Journal:
+    """The journal of one session, written to ``path``.
+
+    The file is only created with the first change, so sessions that are never touched
+    leave nothing behind.
+    """
+    # most seconds between a change and its fsync
+    sync_interval = 1.0
+
+    def __init__(self, path, filename=None):
+        self.path = path
+        self.filename = filename
+        self.file = None
+        self.records = 0
+        self.unsynced = False
+
+    @classmethod
+    def create(cls, filename=None, directory=None):
+        """A new journal in ``directory`` (by default ``autosave_dir()``) for ``filename``."""
+        directory = directory or autosave_dir()
+        return cls(os.path.join(directory, uuid.uuid4().hex + journal_suffix), filename)
+
+    def __len__(self):
+        return self.records
+
+    def write(self, record:dict):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, 'ab')
+            _lock(self.file)
+            self._write({'op': 'session', 'filename': self.filename})
+        self._write(record)
+        self.records += 1
+
+    def _write(self, record):
+        text = json.dumps(record, separators=(',', ':')).encode()
+        self.file.write(b'%08x %s\n' % (zlib.crc32(text), text))
+        # in the operating system's hands from here, so it survives the application crashing
+        self.file.flush()
+        self.unsynced = True
+
+    def add(self, formulas, svgs):
+        self.write({'op': 'add', 'formulas': list(formulas),
+                    'svgs': [(svg or b'').decode() for svg in svgs]})
+
+    def delete(self, row:int, count:int):
+        self.write({'op': 'delete', 'row': row, 'count': count})
+
+    def sync(self):
+        """Make what was written so far survive the machine crashing too."""
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+
+    def reset(self, filename=None):
+        """Start over, once the session has been saved as ``filename``."""
+        self.filename = filename if filename is not None else self.filename
+        self.close(remove=True)
+
+    def close(self, remove=False):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+        self.records = 0
+
+    @staticmethod
+    def read(path):
+        """Return the session filename and the complete records in the journal at ``path``."""
+        filename, records = None, []
+        with open(path, 'rb') as f:
+            for number, line in enumerate(f):
+                crc, _, text = line.rstrip(b'\n').partition(b' ')
+                try:
+                    valid = line.endswith(b'\n') and int(crc, 16) == zlib.crc32(text)
+                    record = json.loads(text) if valid else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    # torn by the crash; nothing after it can be trusted
+                    logging.warning('{}: journal ends at line {}'.format(path, number + 1))
+                    break
+                if not isinstance(record, dict) or 'op' not in record:
+                    logging.warning('{}: bad record at line {}'.format(path, number + 1))
+                    break
+                if record['op'] == 'session':
+                    filename = record['filename']
+                else:
+                    records.append(record)
+        return filename, records
+
+    @staticmethod
+    def leftovers(directory=None) -> list:
+        """The journals in ``directory`` that no running instance is writing to."""
+        directory = directory or autosave_dir()
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            return []
+        paths = []
+        for name in names:
+            path = os.path.join(directory, name)
+            if not name.endswith(journal_suffix):
+                continue
+            with open(path, 'rb') as f:
+                if _lock(f):
+                    paths.append(path)
+        return paths
+
+
+def replay(model, records):
+    """Apply journal ``records`` to ``model``, which holds the session as it was saved.
+
+    The changes go through the model as if they were made now, so they are written to the
+    model's own journal, if it has one.
+    """
+    model.fetch_all()
+    for record in records:
+        if record['op'] == 'add':
+            # a formula that failed to render has an empty svg; older journals wrote null
+            model.append_formulas(record['formulas'],
+                                  [(svg or '').encode() for svg in record['svgs']])
+        elif record['op'] == 'delete':
+            model.removeRows(record['row'], record['count'])
+        else:
+            logging.warning('unknown journal record {}'.format(record['op']))
+
+
+class Autosave(QObject):
+    """Keeps a journal for every session in a SessionTabs, syncing and compacting them."""
+    # milliseconds between compactions of the sessions that have a file
+    compact_interval = 60 * 1000
+    # a journal this many records long is compacted right away
+    compact_records = 1000
+
+    def __init__(self, session_tabs, formula_list, directory=None, parent=None):
+        super().__init__(parent)
+        self.session_tabs = session_tabs
+        self.formula_list = formula_list
+        self.directory = directory
+        self.journals = {}
+
+        for session in session_tabs.sessions:
+            self.attach(session)
+        session_tabs.sessionAdded.connect(self.attach)
+        session_tabs.sessionClosed.connect(self.detach)
+        session_tabs.filenameChanged.connect(self.rename)
+
+        self.sync_timer = QTimer(self)
+        self.sync_timer.timeout.connect(self.sync)
+        self.sync_timer.start(int(Journal.sync_interval * 1000))
+        self.compact_timer = QTimer(self)
+        self.compact_timer.timeout.connect(self.compactAll)
+        self.compact_timer.start(self.compact_interval)
+
+    def attach(self, session):
+        journal = Journal.create(session.filename, self.directory)
+        self.journals[session] = journal
+        session.model.journal = journal
+
+    def detach(self, session):
+        # the session was saved or its changes were let go of
+        journal = self.journals.pop(session, None)
+        if journal is not None:
+            journal.close(remove=True)
+        session.model.journal = None
+
+    def rename(self, session):
+        journal = self.journals.get(session)
+        if journal is not None:
+            journal.filename = session.filename
+
+    def sync(self):
+        for session, journal in self.journals.items():
+            journal.sync()
+            if len(journal) >= self.compact_records:
+                self.compact(session)
+
+    def saved(self, session):
+        """Call after ``session`` was saved: its journal has nothing left to keep."""
+        journal = self.journals.get(session)
+        if journal is not None and not session.model.isModified():
+            journal.reset(session.filename)
+
+    def compact(self, session):
+        journal = self.journals.get(session)
+        if journal is None or not len(journal) or not session.filename:
+            return
+        session.model.save(session.filename, self.formula_list.render_service.cache.context_hash)
+        journal.reset(session.filename)
+        logging.debug('compacted the journal of {}'.format(session.filename))
+        self.session_tabs.updateSessionTitle(session)
+
+    def compactAll(self):
+        for session in list(self.journals):
+            self.compact(session)
+
+    def close(self, discard=False):
+        """Sync everything, removing the journals of sessions with nothing unsaved, or of
+        all of them if their changes are to be ``discard``-ed."""
+        for session, journal in self.journals.items():
+            journal.close(remove=discard or not session.model.isModified())
+
+    def recover(self) -> int:
+        """Reopen the sessions whose journals a crash left behind; return how many."""
+        from session import SessionStore, is_session_file
+        recovered = 0
+        for path in Journal.leftovers(self.directory):
+            if path in (journal.path for journal in self.journals.values()):
+                continue
+            filename, records = Journal.read(path)
+            if not records:
+                os.remove(path)
+                continue
+            session = self.session_tabs.session()
+            if session.filename or session.model.rowCount() or session.model.isModified():
+                session = self.session_tabs.addSession()
+            if filename and is_session_file(filename):
+                session.model.open_store(SessionStore(filename))
+                self.session_tabs.setFilename(filename)
+            # replaying writes the changes to the session's new journal, so the old one goes
+            replay(session.model, records)
+            self.journals[session].sync()
+            os.remove(path)
+            logging.warning('recovered {} changes to {}'.format(len(records),
+                                                                 filename or 'an untitled session'))
+            recovered += 1
+        return recovered
@@ -1,18 +1,34 @@
 #!/usr/bin/env -S python3 -O
-import logging, sys, os
+import time
+# (stage, seconds) checkpoints for --startup-times
+startup_marks = [('start', time.perf_counter())]
+
+def mark_startup(stage):
+    startup_marks.append((stage, time.perf_counter()))
+
+import sys
+if __name__ == '__main__':
+    # a running instance takes over before this one pays for importing Qt
+    import instance
+    if instance.forward(sys.argv[1:]):
+        sys.exit(0)
+
+import logging, os
+import importlib.resources, importlib.util
 from functools import partial
 from PyQt5.QtWidgets import *
-from PyQt5.QtCore import Qt, QUrl, QEvent, QSize, QItemSelection, QItemSelectionModel, QMimeData, pyqtSlot
+from PyQt5.QtCore import (Qt, QUrl, QEvent, QSize, QTimer, QItemSelection, QItemSelectionModel,
+                          QMimeData, pyqtSlot)
 from PyQt5.QtGui import QTextDocument, QPalette, QColor, QCursor, QClipboard, QImage, QPainter
-from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEnginePage, QWebEngineSettings
-from PyQt5.QtSvg import QSvgWidget, QGraphicsSvgItem, QSvgRenderer
 
 from PyQt5.QtWidgets import (QWidget, QSlider, QLineEdit, QLabel, QPushButton, QScrollArea,QApplication,
                              QHBoxLayout, QVBoxLayout, QMainWindow, QSizePolicy, QAbstractItemView)
+mark_startup('PyQt5')
 
 from texsyntax import LatexHighlighter
-import matplotlib.pyplot as plt
-import importlib.resources
+from texvalidate import classify, BROKEN
+from textree import TexTree
+mark_startup('editor')
 
 
 # Only log debug level messages in debug mode
@@ -29,62 +45,77 @@ def pathhelper(resource, package='ui'):
     return path
 
 
-# check age of files..
-# as_file(files(package).joinpath(resource))
-mathmemo_ui_path = pathhelper('mathmemo.ui')
-settings_ui_path = pathhelper('settings.ui')
+def ui_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'mathmemo', 'ui')
 
-for path in [mathmemo_ui_path, settings_ui_path]:
-    source_ctime = 0
-    try:
-        source_ctime = max(os.path.getctime(path), source_ctime)
-    except (FileNotFoundError, PermissionError):
-        source_ctime = 0
-        ui_sources_available = False
-        break
-    else:
-        ui_sources_available = True
 
-mathmemo_ui_py_path = pathhelper('mathmemo_rc.py')
-settings_ui_py_path = pathhelper('settings_ui.py')
-mainwindow_ui_py_path = pathhelper('mainwindow_ui.py')
+def compiled_ui(ui_path, class_name):
+    """Return the form class defined by ``ui_path``.
 
+    The .ui file is compiled to Python once and kept in the cache under its mtime and size,
+    so later starts import the compiled module instead of running uic.
+    """
+    stat = os.stat(ui_path)
+    stem = os.path.splitext(os.path.basename(ui_path))[0]
+    module_name = 'mathmemo_ui_{}_{}_{}'.format(stem, stat.st_mtime_ns, stat.st_size)
+    directory = ui_cache_dir()
+    py_path = os.path.join(directory, module_name + '.py')
+
+    if not os.path.exists(py_path):
+        logging.debug('compiling %s', ui_path)
+        from PyQt5 import uic
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith('mathmemo_ui_{}_'.format(stem)):
+                os.remove(os.path.join(directory, name))
+        tmp_path = py_path + '.tmp'
+        with open(tmp_path, 'wt') as f:
+            uic.compileUi(str(ui_path), f, from_imports=True, import_from='ui')
+        os.replace(tmp_path, py_path)
+
+    spec = importlib.util.spec_from_file_location(module_name, py_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
 
-for path in [mainwindow_ui_py_path, settings_ui_py_path, mainwindow_ui_py_path]:
-    generated_ctime = sys.maxsize
-    try:
-        generated_ctime = min(os.path.getctime(path), generated_ctime)
-    except (FileNotFoundError, PermissionError):
-        source_ctime = 0
-        ui_generated_available = False
-        break
-    else:
-        ui_generated_available = True
 
-# if ANY .ui file is newer than any generated .py file, prefer compiling the UI.
-# I.E. ONLY use generated files if they are newer
-if ui_sources_available and (source_ctime > generated_ctime or not ui_generated_available):
+mathmemo_ui_path = pathhelper('mathmemo.ui')
+settings_ui_path = pathhelper('settings.ui')
+
+try:
+    Ui_MainWindow = compiled_ui(mathmemo_ui_path, 'Ui_MainWindow')
+    Ui_settings = compiled_ui(settings_ui_path, 'Ui_settings')
+except FileNotFoundError:
+    # installs without the .ui sources ship the generated modules instead
+    try:
+        logging.debug('importing generated files')
+        from ui.mainwindow_ui import Ui_MainWindow
+        from ui.settings_ui import Ui_settings
+    except ImportError:
+        logging.critical('UI imports unavailable, exiting...')
+        sys.exit(-1)
+except OSError:
+    # no usable cache directory; compile in memory every time
     logging.debug('importing ui files')
     from PyQt5 import uic
-    ###Ui_MainWindow, _ = uic.loadUiType('ui/mathmemo.ui', from_imports=True, import_from='ui')
-    ###Ui_settings, _ = uic.loadUiType('ui/settings.ui', from_imports=True, import_from='ui')
     Ui_MainWindow, _ = uic.loadUiType(mathmemo_ui_path, from_imports=True, import_from='ui')
     Ui_settings, _ = uic.loadUiType(settings_ui_path, from_imports=True, import_from='ui')
-elif ui_generated_available:
-    logging.debug('importing generated files')
-    from ui.mainwindow_ui import Ui_MainWindow
-    from ui.settings_ui import Ui_settings
-else:
-    logging.critical('UI imports unavailable, exiting...')
-    sys.exit(-1)
-
+mark_startup('ui')
 
 
-from pysvg.parser import parse
-
 #from mjrender import (context, mathjax_v2_url, mathjax_url_remote, mathjax_url, mathjax_v2_config,
 #                      mathjax_config, page_template)
-from mjrender import page_template
+from renderservice import RenderService
+from findbar import FindBar
+from sessiontabs import SessionTabs
+from journal import Autosave
+from formulalib import FormulaLibrary, LibraryModel, is_library_file
+from formulalist import FormulaList
+from session import session_suffix, is_session_file
+
+session_filter = 'MathMemo sessions (*.mathmemo);;Text files (*.txt);;All files (*)'
+library_filter = 'Formula libraries (*.mmlib);;All files (*)'
 '''
 void setHeight (QPlainTextEdit *ptxt, int nRows)
 {
@@ -98,44 +129,65 @@ void setHeight (QPlainTextEdit *ptxt, int nRows)
 }
 '''
 
-plt.rc('mathtext', fontset='cm')
+
+def report_startup(stream=sys.stderr):
+    previous = startup_marks[0][1]
+    for stage, when in startup_marks[1:]:
+        print('{:<12} {:8.1f} ms  {:8.1f} ms'.format(stage, (when - previous) * 1000,
+                                                   (when - startup_marks[0][1]) * 1000),
+              file=stream)
+        previous = when
 
 
 class MainEqWindow(QMainWindow, Ui_MainWindow):
+    # mark the cursor position or selection in the preview while editing inside the formula
+    preview_cursor = True
+
     def __init__(self):
         super().__init__()
         self.initUI()
-        self.page_template = page_template
-        self.formula_svg = None
-        self.eq_queue = []
-        self.svg_queue = []
         self.copy_mode = 'image'
-        self.default_filename = None
+        self.library_dock = None
 
     def initUI(self):
         self.setupUi(self)
 
         self.highlight = LatexHighlighter(self.input_box.document())
 
-        # use a separate QWebEngineView for rendering.  Might could be a QWebEnginePage
-        # I think I did it like this because I was worried that the page processing was
-        # asynchronous and worried if we started to enter a new formula very quickly, that
-        # it might interfere with what got inserted into the list.
-
-        self.render = QWebEnginePage()
-
         #self.input_box.setPlaceholderText("Enter a formula here...")
 
         self.input_box.installEventFilter(self)
 
         # sets proportions for the eq list, preview & input widgets
         self.splitter.setSizes([500, 350, 150])
-        # self.preview.page().loadFinished.connect(self._on_load_finished)
-        # self.render.loadFinished.connect(self._on_load_finished)
-        self.render.loadFinished.connect(self._on_load_finished)
 
+        # one renderer for the whole window: the list, the preview and copies all go
+        # through it, so there is a single set of MathJax pages and a single cache
+        self.render_service = RenderService(parent=self)
+        self.eq_list.setRenderService(self.render_service)
+        self.preview.setRenderService(self.render_service)
         self.input_box.textChanged.connect(self.updatePreview)
 
+        # parse tree of the formula being edited, updated from each change to the document
+        self.formula_tree = TexTree()
+        self.input_box.document().contentsChange.connect(self.updateFormulaTree)
+        self.input_box.cursorPositionChanged.connect(self.updatePreview)
+
+        # find bar above the list, hidden until Edit > Find
+        self.find_bar = FindBar(self.centralwidget)
+        self.find_bar.setFormulaList(self.eq_list)
+        self.find_bar.hide()
+        self.verticalLayout.insertWidget(0, self.find_bar)
+
+        # one tab per open session, all shown in eq_list and rendered by the same service
+        self.session_tabs = SessionTabs(self.centralwidget)
+        self.session_tabs.setFormulaList(self.eq_list)
+        self.find_bar.setSessionTabs(self.session_tabs)
+        self.session_tabs.tabCloseRequested.connect(self.closeTab)
+        self.verticalLayout.insertWidget(0, self.session_tabs)
+        # every change is journaled as it is made, so a crash loses nothing
+        self.autosave = Autosave(self.session_tabs, self.eq_list, parent=self)
+
         # settings UI
         self.settings_ui = Ui_settings()
         self.settings_dialog = QDialog()
@@ -158,9 +210,31 @@ class MainEqWindow(QMainWindow, Ui_MainWindow):
 
         self.copy_profile_button.setMenu(self.copy_menu)
 
+        QTimer.singleShot(0, self.startRenderer)
+
+    def startRenderer(self):
+        # QtWebEngine takes a while to load; the window is already up and accepting input
+        mark_startup('shown')
+        self.render_service.start()
+        mark_startup('webengine')
+
+    def updateFormulaTree(self, position, removed, added):
+        self.formula_tree.edit(position, removed, added, self.input_box.toPlainText())
+
     def updatePreview(self):
         formula_str = self.input_box.toPlainText()
-        self.preview.setHtml(self.page_template.format(formula=formula_str), QUrl('file://'))
+        cursor = self.input_box.textCursor()
+        if self.preview_cursor and self.formula_tree.text == formula_str:
+            if cursor.hasSelection():
+                formula_str = self.formula_tree.selection_marked(
+                    cursor.selectionStart(), cursor.selectionEnd()) or formula_str
+            elif cursor.position() < len(formula_str):
+                formula_str = self.formula_tree.cursor_marked(cursor.position())
+        # half-typed input is previewed with tentative closers added; input that can't
+        # render keeps the last good preview up instead of sending anything to MathJax
+        state, formula_str = classify(formula_str)
+        if state != BROKEN:
+            self.preview.setFormula(formula_str)
 
     def eventFilter(self, obj, event):
         if obj is self.input_box and event.type() == QEvent.FocusIn:
@@ -176,38 +250,98 @@ class MainEqWindow(QMainWindow, Ui_MainWindow):
 
         return super().eventFilter(obj, event)
 
-    def add_current_formula_old(self):
-        formula_str = self.input_box.toPlainText()
-
-        if formula_str:
-            print('appending formula: ', formula_str)
-            self.eq_queue.append(formula_str)
-            print('svg: ', self.formula_svg)
-            self.input_box.clear()
-            self.render.setHtml(self.page_template.format(formula=formula_str),
-                                QUrl('file://'))
-
     def add_current_formula(self):
         formula_str = self.input_box.toPlainText()
 
         if formula_str:
             print('appending formula: ', formula_str)
             self.eq_list.append_formula(formula_str)
-            print('svg: ', self.formula_svg)
             self.input_box.clear()
 
-    def _on_load_finished(self):
-        # Extract the SVG output from the page and add an XML header
-        xml_header = b'<?xml version="1.0" encoding="utf-8" standalone="no"?>'
-        self.render.runJavaScript("""
-            var mjelement = document.getElementById('mathjax-container');
-            mjelement.getElementsByTagName('svg')[0].outerHTML;
-        """, lambda result: self.update_svg(xml_header + result.encode()))
+    def handleRequest(self, request):
+        """Open the files and add the formulas in a request from the command line, then
+        bring the window to the front."""
+        for filename in request.get('files', []):
+            if not os.path.exists(filename):
+                logging.warning('no such file: %s', filename)
+                continue
+            self.openFile(filename)
+        if request.get('formulas'):
+            self.eq_list.append_formulas(request['formulas'])
+        self.showNormal()
+        self.raise_()
+        self.activateWindow()
+        self.input_box.setFocus()
+
+    @property
+    def default_filename(self):
+        return self.session_tabs.session().source
+
+    def openFile(self, filename):
+        if is_library_file(filename):
+            self.openLibrary(filename)
+            return
+        # into a new tab, unless the current one is an untouched empty session
+        session = self.session_tabs.session()
+        if session.source or session.model.rowCount() or session.model.isModified():
+            session = self.session_tabs.addSession()
+        if is_session_file(filename):
+            self.session_tabs.setFilename(filename)
+        else:
+            session.source = filename
+        self.eq_list.open(filename)
+
+    def openLibrary(self, filename):
+        """Show the library in ``filename`` in the library panel, in place of the last one."""
+        try:
+            model = LibraryModel(FormulaLibrary(filename))
+        except (OSError, ValueError) as error:
+            QMessageBox.warning(self, 'Open Library', str(error))
+            return
+        if self.library_dock is None:
+            self.library_list = FormulaList(self)
+            self.library_list.setRenderService(self.render_service)
+            # a formula picked from the library goes into the current session
+            self.library_list.activated.connect(self.addLibraryFormula)
+            self.library_dock = QDockWidget(self)
+            self.library_dock.setObjectName('library_dock')
+            self.library_dock.setWidget(self.library_list)
+            self.addDockWidget(Qt.LeftDockWidgetArea, self.library_dock)
+        old = self.library_list.formula_model
+        self.library_list.setFormulaModel(model)
+        if isinstance(old, LibraryModel):
+            old.close()
+        self.library_dock.setWindowTitle('{} ({} formulas)'.format(os.path.basename(filename),
+                                                                   model.rowCount()))
+        self.library_dock.show()
+
+    def addLibraryFormula(self, index):
+        self.eq_list.append_formula(index.data(LibraryModel.FormulaRole),
+                                    index.data(LibraryModel.SvgRole))
+
+    def closeTab(self, index):
+        session = self.session_tabs.session(index)
+        if session.model.isModified():
+            self.session_tabs.setCurrentIndex(index)
+            response = QMessageBox.question(
+                self, 'Close Tab', 'Save the formulas in this tab before closing it?',
+                QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel, QMessageBox.Save)
+            if response == QMessageBox.Cancel:
+                return
+            if response == QMessageBox.Save:
+                self.on_actionSave_triggered()
+                if session.model.isModified():
+                    return
+        self.session_tabs.closeSession(index)
+
+    @pyqtSlot()
+    def on_actionNew_Tab_triggered(self):
+        self.session_tabs.addSession()
+        self.input_box.setFocus()
 
-    def update_svg(self, svg:bytes):
-        # add XML header
-        formula = self.eq_queue.pop(0)
-        self.eq_list.append_formula_svg(formula, svg)
+    @pyqtSlot()
+    def on_actionClose_Tab_triggered(self):
+        self.closeTab(self.session_tabs.currentIndex())
 
     @pyqtSlot()
     def on_add_formula_button_clicked(self):
@@ -228,30 +362,58 @@ class MainEqWindow(QMainWindow, Ui_MainWindow):
         )
         QMessageBox.about(self, 'About MathMemo', about_text)
 
+    @pyqtSlot()
+    def on_actionFind_triggered(self):
+        self.find_bar.activate()
+
+    @pyqtSlot(bool)
+    def on_actionCollapse_Duplicates_toggled(self, checked):
+        self.eq_list.setCollapseDuplicates(checked)
+
     @pyqtSlot()
     def on_actionSave_As_triggered(self):
-        filename, filter = QFileDialog.getSaveFileName(self, self.tr('Save F:xile'), '', '')
+        filename, filter = QFileDialog.getSaveFileName(self, self.tr('Save F:xile'),
+                                                       self.default_filename or '',
+                                                       self.tr(session_filter))
         if filename:
-            self.default_filename = filename
-            self.eq_list.save_as_text(filename)
+            if filter == self.tr(session_filter).split(';;')[0] and '.' not in os.path.basename(filename):
+                filename += session_suffix
+            self.eq_list.save(filename)
+            if filename.endswith(session_suffix):
+                self.session_tabs.setFilename(filename)
+                self.autosave.saved(self.session_tabs.session())
+            else:
+                self.session_tabs.session().source = filename
 
     @pyqtSlot()
     def on_actionSave_triggered(self):
         if self.default_filename:
-            self.eq_list.save_as_text(self.default_filename)
+            self.eq_list.save(self.default_filename)
+            self.session_tabs.updateTitle(self.session_tabs.currentIndex())
+            self.autosave.saved(self.session_tabs.session())
         else:
             self.on_actionSave_As_triggered()
 
     @pyqtSlot()
     def on_actionOpen_triggered(self):
-        filename, filter = QFileDialog.getOpenFileName(self, self.tr('Open F:xile'), '', '')
+        filename, filter = QFileDialog.getOpenFileName(self, self.tr('Open F:xile'), '',
+                                                       self.tr(session_filter))
+        if filename:
+            self.openFile(filename)
+
+    def modifiedSessions(self):
+        return [session for session in self.session_tabs.sessions if session.model.isModified()]
+
+    @pyqtSlot()
+    def on_actionOpen_Library_triggered(self):
+        filename, _ = QFileDialog.getOpenFileName(self, self.tr('Open Library'), '',
+                                                  self.tr(library_filter))
         if filename:
-            self.default_filename = filename
-            self.eq_list.load_from_text(filename)
+            self.openLibrary(filename)
 
     @pyqtSlot()
     def on_actionQuit_triggered(self):
-        if self.eq_list.isWindowModified() or True:
+        if self.modifiedSessions():
             quit_dialog = QMessageBox()
             quit_dialog.setText("You have unsaved formulas.")
             quit_dialog.setInformativeText(
@@ -263,14 +425,78 @@ class MainEqWindow(QMainWindow, Ui_MainWindow):
             response = quit_dialog.exec_()
 
             if response == QMessageBox.StandardButton.Save:
-                self.on_actionSave_triggered()
+                for session in self.modifiedSessions():
+                    self.session_tabs.setCurrentIndex(self.session_tabs.sessions.index(session))
+                    self.on_actionSave_triggered()
+                if self.modifiedSessions():
+                    # a save was cancelled
+                    return
+                self.autosave.close()
                 app.quit()
             elif response == QMessageBox.StandardButton.Discard:
+                self.autosave.close(discard=True)
                 app.quit()
+        else:
+            self.autosave.close()
+            app.quit()
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='mathmemo', description='A pasteboard for math equations.',
+                                     epilog='Run "mathmemo render -h" or "mathmemo bench -h" for '
+                                            'the command line tools.')
+    if argv[:1] in (['render'], ['bench']):
+        commands = parser.add_subparsers(dest='command')
+        render_parser = commands.add_parser('render', help='render formulas without the GUI')
+        import batchrender
+        batchrender.add_arguments(render_parser)
+        bench_parser = commands.add_parser('bench', help='run the render benchmarks')
+        import benchmark
+        benchmark.add_arguments(bench_parser)
+    else:
+        # files can't share the top level with subcommands, so the GUI gets its own parser
+        parser.add_argument('files', nargs='*',
+                            help='sessions or text files to open; - reads formulas from stdin')
+        parser.add_argument('--new-instance', action='store_true',
+                            help="don't hand the arguments to a running MathMemo")
+        parser.add_argument('--daemon', action='store_true',
+                            help='keep running after the window is closed, so it can be summoned')
+        parser.add_argument('--startup-times', action='store_true',
+                            help='print how long each stage of startup took')
+        parser.set_defaults(command=None)
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.command == 'render':
+        import batchrender
+        sys.exit(batchrender.main(args))
+    elif args.command == 'bench':
+        import benchmark
+        sys.exit(benchmark.main(args))
+
+    # lets QtWebEngine be imported after the application has been created
+    QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
+    mark_startup('application')
     main = MainEqWindow()
+    # a standalone run (--startup-times) must not take the running instance's socket
+    if not args.new_instance and not args.startup_times:
+        from instanceserver import InstanceServer
+        instance_server = InstanceServer(parent=main)
+        instance_server.requested.connect(main.handleRequest)
+        instance_server.listen()
+    if args.daemon:
+        app.setQuitOnLastWindowClosed(False)
     main.show()
+    mark_startup('window')
+    # sessions a crash left unsaved come back first
+    main.autosave.recover()
+    if args.files:
+        main.handleRequest(instance.make_request(args.files))
+    if args.startup_times:
+        # runs after the deferred renderer setup
+        QTimer.singleShot(0, report_startup)
     sys.exit(app.exec_())
@@ -0,0 +1,58 @@
+// Typesets TeX to SVG with mathjax-full for mjnode.NodeRenderer.
+//
+// Requests and replies are JSON, one per line.  The first request is {"context": macros},
+// typeset once so the macros are defined for the rest of the session, and is answered
+// with {"ready": version}.  After that each {"job": n, "formulas": [...]} is answered with
+// {"job": n, "svgs": [...], "timings": [[typeset ms, svg extraction ms], ...]}.
+//
+// The configuration follows the es5/tex-svg-full.js page in mjpage.py (all TeX packages,
+// display math, local font cache) so the svgs match what the QtWebEngine backend produces.
+const readline = require('readline');
+const {performance} = require('perf_hooks');
+const {mathjax} = require('mathjax-full/js/mathjax.js');
+const {TeX} = require('mathjax-full/js/input/tex.js');
+const {SVG} = require('mathjax-full/js/output/svg.js');
+const {liteAdaptor} = require('mathjax-full/js/adaptors/liteAdaptor.js');
+const {RegisterHTMLHandler} = require('mathjax-full/js/handlers/html.js');
+const {AllPackages} = require('mathjax-full/js/input/tex/AllPackages.js');
+const {version} = require('mathjax-full/package.json');
+
+const adaptor = liteAdaptor();
+RegisterHTMLHandler(adaptor);
+const html = mathjax.document('', {
+    InputJax: new TeX({packages: AllPackages}),
+    OutputJax: new SVG({fontCache: 'local'})
+});
+
+function typeset(formula) {
+    const start = performance.now();
+    try {
+        const node = html.convert(formula, {display: true});
+        const typeset = performance.now();
+        // the page hands back the <svg> inside the mjx-container, so do the same
+        const svg = adaptor.outerHTML(adaptor.firstChild(node));
+        return [svg, typeset - start, performance.now() - typeset];
+    } catch (err) {
+        console.error('typeset failed: ' + err);
+        return ['', performance.now() - start, 0];
+    }
+}
+
+function reply(message) {
+    process.stdout.write(JSON.stringify(message) + '\n');
+}
+
+readline.createInterface({input: process.stdin}).on('line', function (line) {
+    const request = JSON.parse(line);
+    if ('context' in request) {
+        typeset(request.context);
+        reply({ready: version});
+        return;
+    }
+    const results = request.formulas.map(typeset);
+    reply({
+        job: request.job,
+        svgs: results.map(function (result) { return result[0]; }),
+        timings: results.map(function (result) { return result.slice(1); })
+    });
+});
@@ -0,0 +1,109 @@
+"""MathJax in a local node process, an alternative to a QtWebEngine page.
+
+Needs ``node`` and the ``mathjax-full`` package, e.g. ``npm install mathjax-full`` next to
+this file or anywhere on NODE_PATH.  No Chromium is involved, so a page costs one node
+process and typesetting skips the web channel round trip.
+"""
+import json, logging, os
+from PyQt5.QtCore import QCoreApplication, QObject, QProcess, pyqtSignal
+from mjpage import macros, xml_header
+
+node_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mjnode.js')
+
+
+class NodeRenderer(QObject):
+    """Typesets formulas in a persistent node process running mjnode.js.
+
+    Has the same interface as mjrender.MathJaxRenderer, so RenderPool can use either.
+    Requests are written to the process as they are submitted; node reads them in order,
+    after the macros have been defined.
+    """
+    ready = pyqtSignal(str)
+    timed = pyqtSignal(int, list)
+    failed = pyqtSignal()
+
+    node = os.environ.get('MATHMEMO_NODE', 'node')
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.mathjax_version = None
+        self.next_job = 0
+        self.callbacks = {}
+        self.buffer = b''
+        self.abandoned = False
+
+        self.process = QProcess(self)
+        self.process.setProcessChannelMode(QProcess.SeparateChannels)
+        self.process.readyReadStandardOutput.connect(self._on_output)
+        self.process.readyReadStandardError.connect(self._on_error_output)
+        self.process.finished.connect(self._on_finished)
+        self.process.errorOccurred.connect(self._on_process_error)
+        self.process.start(self.node, [node_script])
+        self._write({'context': macros})
+        QCoreApplication.instance().aboutToQuit.connect(self.close)
+
+    def isReady(self):
+        return self.mathjax_version is not None
+
+    def submit(self, formula:str, callback=None) -> int:
+        return self._queue([formula], callback, False)
+
+    def submit_batch(self, formulas:list, callback=None) -> int:
+        return self._queue(list(formulas), callback, True)
+
+    def close(self):
+        # node exits once its stdin is closed
+        self.abandoned = True
+        self.process.closeWriteChannel()
+        self.process.waitForFinished(1000)
+
+    def abandon(self):
+        """Drop every outstanding job and stop the process."""
+        self.abandoned = True
+        self.callbacks.clear()
+        self.process.kill()
+
+    def _queue(self, formulas, callback, batch):
+        job = self.next_job
+        self.next_job += 1
+        self.callbacks[job] = (callback, batch)
+        self._write({'job': job, 'formulas': formulas})
+        return job
+
+    def _write(self, message):
+        self.process.write(json.dumps(message).encode() + b'\n')
+
+    def _on_output(self):
+        self.buffer += bytes(self.process.readAllStandardOutput())
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            if line:
+                self._on_message(json.loads(line))
+
+    def _on_message(self, message):
+        if 'ready' in message:
+            logging.debug('MathJax {} ready in node'.format(message['ready']))
+            self.mathjax_version = message['ready']
+            self.ready.emit(self.mathjax_version)
+            return
+
+        job = message['job']
+        callback, batch = self.callbacks.pop(job, (None, False))
+        self.timed.emit(job, message['timings'])
+        svgs = [xml_header + svg.encode() for svg in message['svgs']]
+        if callback is not None:
+            callback(svgs if batch else svgs[0])
+
+    def _on_error_output(self):
+        for line in bytes(self.process.readAllStandardError()).decode(errors='replace').splitlines():
+            logging.debug('node: {}'.format(line))
+
+    def _on_finished(self, code, status):
+        if not self.abandoned:
+            logging.error('node renderer exited ({})'.format(code))
+            self.failed.emit()
+
+    def _on_process_error(self, error):
+        if error == QProcess.FailedToStart:
+            logging.error('could not start {} for the node renderer'.format(self.node))
+            self.failed.emit()
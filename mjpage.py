@@ -0,0 +1,215 @@
+"""The MathJax pages and the render context, kept free of Qt imports.
+
+The render cache only needs to know what a rendered formula depends on, so it can use
+this module without pulling in QtWebEngine at startup.
+"""
+import json, os
+
+
+macros = r'''\newcommand{\Ex}{\mathop{\rm Ex}}
+               \newcommand{\T}{\mathop{\rm T}}
+               \newcommand{\range}{\mathop{\rm range}}
+           '''
+
+context = macros.replace('{', '{{').replace('}', '}}')
+
+
+mathjax_v2_url = "file:///usr/share/javascript/mathjax/MathJax.js?delayStartupUntil=onload"
+mathjax_url_remote = "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-svg.js?delayStartupUntil=onload"
+
+mathjax_url = 'file:///usr/share/javascript/mathjax@3/es5/tex-svg-full.js'
+
+mathjax_config_old = """
+      MathJax.Hub.Config({
+        showMathMenu: false,
+        jax: ['input/TeX', 'output/SVG'],
+        extensions: ['tex2jax.js', 'MathMenu.js', 'MathZoom.js'],
+        TeX: {
+          extensions: ['AMSmath.js', 'AMSsymbols.js', 'noErrors.js', 'noUndefined.js']
+        }
+      });
+""".replace('{', '{{').replace('}', '}}')
+
+mathjax_config_v2_old = """
+      MathJax.Hub.Config({
+        showMathMenu: false,
+        jax: ['input/TeX', 'output/SVG'],
+        extensions: ['tex2jax.js', 'MathMenu.js', 'MathZoom.js'],
+        TeX: {
+          extensions: ['AMSmath.js', 'AMSsymbols.js', 'noErrors.js', 'noUndefined.js']
+        }
+      });
+""".replace('{', '{{').replace('}', '}}')
+
+mathjax_v2_config = """
+      MathJax.Hub.Config({
+        jax: ["input/TeX","input/MathML","input/AsciiMath","output/SVG"],
+        extensions: ["tex2jax.js","mml2jax.js","asciimath2jax.js","MathMenu.js",
+                     "MathZoom.js","AssistiveMML.js", "a11y/accessibility-menu.js"],
+        TeX: { extensions:
+          ["AMSmath.js","AMSsymbols.js","noErrors.js","noUndefined.js"]
+      });
+""".replace('{', '{{').replace('}', '}}')
+
+mathjax_config = """
+window.MathJax = {
+    options: {
+        enableMenu: false, ignoreHtmlClass:
+            'tex2jax_ignore', processHtmlClass:
+            'tex2jax_process' },
+    tex: { packages: ['base', 'ams', 'noerrors', 'noundefined', '+', 'color']
+           color: { padding: 5px
+                    borderWidth: 5px
+           }
+    },
+    loader: { load: ['input/tex-base', 'output/svg', 'ui/menu',
+                      '[tex]/require'] },
+};
+""".replace('{', '{{').replace('}', '}}')
+
+page_template = """
+<html>
+  <head>
+    <script type="text/javascript" id="MathJax-script"
+      src="{url}">
+    </script>
+    <script type="text/x-mathjax-config">
+        {config}
+    </script>
+  </head>
+  <body>
+    <div style="background-color: white">
+      <mathjax id="mathjax-context" style="font-size:2.3em">\[{context}\]</mathjax>
+      <mathjax id="mathjax-container" style="font-size:2.3em">\[{{formula}}\]</mathjax>
+    </div>
+  </body>
+</html>
+""".format(url=mathjax_url, context=context, config=mathjax_config)
+
+# The engine page is loaded exactly once per MathJaxRenderer.  MathJax is configured to skip
+# its initial typeset pass, the context macros are defined once at startup, and afterwards
+# each formula is typeset on demand through tex2svgPromise and handed back over the web
+# channel.  Jobs are chained so results always come back in submission order.
+engine_config = """
+window.MathJax = {
+    options: { enableMenu: false },
+    startup: {
+        typeset: false,
+        ready: function () {
+            MathJax.startup.defaultReady();
+            MathJax.startup.promise.then(mmStartup);
+        }
+    }
+};
+"""
+
+engine_script = """
+var mmBridge = null;
+var mmPending = 2;
+var mmChain = Promise.resolve();
+
+function mmStartup() {
+    if (--mmPending == 0) {
+        MathJax.tex2svg(mmContext, {display: true});
+        mmBridge.mathjaxReady(MathJax.version);
+    }
+}
+
+function mmSvg(node) {
+    var svg = node.getElementsByTagName('svg')[0];
+    return svg ? svg.outerHTML : '';
+}
+
+function mmTimed(formula) {
+    // resolves to [svg, typeset ms, svg extraction ms]
+    var start = performance.now();
+    return MathJax.tex2svgPromise(formula, {display: true}).then(function (node) {
+        var typeset = performance.now();
+        var svg = mmSvg(node);
+        return [svg, typeset - start, performance.now() - typeset];
+    }, function (err) {
+        console.error('typeset failed: ' + err);
+        return ['', performance.now() - start, 0];
+    });
+}
+
+function mmTypeset(job, formula) {
+    mmChain = mmChain.then(function () {
+        return mmTimed(formula);
+    }).then(function (result) {
+        mmBridge.svgReady(job, result[0], [result.slice(1)]);
+    });
+}
+
+function mmTypesetBatch(job, formulas) {
+    var svgs = [];
+    var timings = [];
+    mmChain = mmChain.then(function () {
+        // typeset one formula after another so a batch costs a single round trip
+        return formulas.reduce(function (done, formula) {
+            return done.then(function () {
+                return mmTimed(formula);
+            }).then(function (result) {
+                svgs.push(result[0]);
+                timings.push(result.slice(1));
+            });
+        }, Promise.resolve());
+    }).then(function () {
+        mmBridge.batchReady(job, svgs, timings);
+    });
+}
+
+new QWebChannel(qt.webChannelTransport, function (channel) {
+    mmBridge = channel.objects.bridge;
+    mmStartup();
+});
+"""
+
+engine_template = """
+<html>
+  <head>
+    <script type="text/javascript" src="qrc:///qtwebchannel/qwebchannel.js"></script>
+    <script type="text/javascript">
+      var mmContext = {context};
+      {config}
+      {script}
+    </script>
+    <script type="text/javascript" id="MathJax-script" src="{url}"></script>
+  </head>
+  <body>
+    {body}
+  </body>
+</html>
+"""
+
+engine_page = engine_template.format(url=mathjax_url, context=json.dumps(macros),
+                                     config=engine_config, script=engine_script, body='')
+
+def mathjax_version(url=mathjax_url):
+    """Best-effort version string for the MathJax bundle at ``url``, without loading it.
+
+    Local installs are identified by the package.json that ships next to the es5
+    directory, falling back to the size and mtime of the bundle itself.
+    """
+    if not url.startswith('file://'):
+        return url
+
+    path = url[len('file://'):]
+    package = os.path.join(os.path.dirname(os.path.dirname(path)), 'package.json')
+    try:
+        with open(package, 'rt') as f:
+            return json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 'unavailable'
+    return 'unknown-{}-{}'.format(stat.st_size, int(stat.st_mtime))
+
+
+# everything other than the formula itself that the rendered svg depends on
+render_context = '\0'.join([macros, engine_config, engine_script, mathjax_url, mathjax_version()])
+
+xml_header = b'<?xml version="1.0" encoding="utf-8" standalone="no"?>'
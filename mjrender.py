@@ -3,11 +3,13 @@
 #from PyQt5.QtWidgets import *
 #from PyQt5.QtCore import Qt, QUrl, QEvent, QSize, QItemSelection, QItemSelectionModel, QMimeData, pyqtSlot
 #from PyQt5.QtGui import QTextDocument, QPalette, QColor, QCursor, QClipboard, QImage, QPainter
-from PyQt5.QtWebEngineWidgets import QWebEnginePage, QWebEngineView, QWebEngineSettings
+import json, logging
+from PyQt5.QtCore import QObject, QUrl, pyqtSignal, pyqtSlot
+from PyQt5.QtWebEngineWidgets import QWebEnginePage
+from PyQt5.QtWebChannel import QWebChannel
+from mjpage import engine_page, page_template, xml_header
 #from PyQt5.QtSvg import QSvgWidget, QGraphicsSvgItem, QSvgRenderer
-#from io import BytesIO
 #from texsyntax import LatexHighlighter
-import matplotlib.pyplot as plt
 #
 #from PyQt5.QtWidgets import (QWidget, QSlider, QLineEdit, QLabel, QPushButton, QScrollArea,QApplication,
 #                             QHBoxLayout, QVBoxLayout, QMainWindow, QSizePolicy, QAbstractItemView)
@@ -21,157 +23,119 @@ import matplotlib.pyplot as plt
 # from PyQt5 import Qt
 # 'PyQt5.QtWebEngineWidgets.QWebEngineSettings.ShowScrollBars'
 
-
-context = r'''\newcommand{\Ex}{\mathop{\rm Ex}}
-               \newcommand{\T}{\mathop{\rm T}}
-               \newcommand{\range}{\mathop{\rm range}}
-           '''.replace('{', '{{').replace('}', '}}')
-
-
-mathjax_v2_url = "file:///usr/share/javascript/mathjax/MathJax.js?delayStartupUntil=onload"
-mathjax_url_remote = "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-svg.js?delayStartupUntil=onload"
-
-mathjax_url = 'file:///usr/share/javascript/mathjax@3/es5/tex-svg-full.js'
-
-mathjax_config_old = """
-      MathJax.Hub.Config({
-        showMathMenu: false,
-        jax: ['input/TeX', 'output/SVG'],
-        extensions: ['tex2jax.js', 'MathMenu.js', 'MathZoom.js'],
-        TeX: {
-          extensions: ['AMSmath.js', 'AMSsymbols.js', 'noErrors.js', 'noUndefined.js']
-        }
-      });
-""".replace('{', '{{').replace('}', '}}')
-
-mathjax_config_v2_old = """
-      MathJax.Hub.Config({
-        showMathMenu: false,
-        jax: ['input/TeX', 'output/SVG'],
-        extensions: ['tex2jax.js', 'MathMenu.js', 'MathZoom.js'],
-        TeX: {
-          extensions: ['AMSmath.js', 'AMSsymbols.js', 'noErrors.js', 'noUndefined.js']
-        }
-      });
-""".replace('{', '{{').replace('}', '}}')
-
-mathjax_v2_config = """
-      MathJax.Hub.Config({
-        jax: ["input/TeX","input/MathML","input/AsciiMath","output/SVG"],
-        extensions: ["tex2jax.js","mml2jax.js","asciimath2jax.js","MathMenu.js",
-                     "MathZoom.js","AssistiveMML.js", "a11y/accessibility-menu.js"],
-        TeX: { extensions:
-          ["AMSmath.js","AMSsymbols.js","noErrors.js","noUndefined.js"]
-      });
-""".replace('{', '{{').replace('}', '}}')
-
-mathjax_config = """
-window.MathJax = {
-    options: {
-        enableMenu: false, ignoreHtmlClass:
-            'tex2jax_ignore', processHtmlClass:
-            'tex2jax_process' },
-    tex: { packages: ['base', 'ams', 'noerrors', 'noundefined', '+', 'color']
-           color: { padding: 5px
-                    borderWidth: 5px
-           }
-    },
-    loader: { load: ['input/tex-base', 'output/svg', 'ui/menu',
-                      '[tex]/require'] },
-};
-""".replace('{', '{{').replace('}', '}}')
-
-page_template = """
-<html>
-  <head>
-    <script type="text/javascript" id="MathJax-script"
-      src="{url}">
-    </script>
-    <script type="text/x-mathjax-config">
-        {config}
-    </script>
-  </head>
-  <body>
-    <div style="background-color: white">
-      <mathjax id="mathjax-context" style="font-size:2.3em">\[{context}\]</mathjax>
-      <mathjax id="mathjax-container" style="font-size:2.3em">\[{{formula}}\]</mathjax>
-    </div>
-  </body>
-</html>
-""".format(url=mathjax_url, context=context, config=mathjax_config)
-
-plt.rc('mathtext', fontset='cm')
-
-def render_latex_as_svg(latex_formula):
-    fig, ax = plt.subplots()
-    ax.text(0.5, 0.5, fr'${latex_formula}$', size=30, ha='center', va='center')
-    # ax.text(0.5, 0.5, fr'[{latex_formula}]', size=30, ha='center', va='center')
-    ax.set_axis_off()
-    buffer = BytesIO()
-    plt.savefig(buffer, format='svg')
-    svg_image = buffer.getvalue()
-    buffer.close()
-    plt.close(fig)
-    return svg_image
-
-class MathJaxRender(QWebEnginePage):
-    def __init__(self):
-        super().__init__()
-        self.page_template = page_template
-
-        # self.loadFinished.connect(self._on_load_finished)
-
-        self.copy_profile_button.setMenu(self.copy_menu)
-
-    def append_content(self, content):
-        # Append the formula to the list box
-        content_html= f"{content}<br>"
-        if '\\(' in content and '\\)' in content:
-            # Use MathJax to render math expressions enclosed in \( and \)
-            content_html = content_html.replace('\\(', '<mathjax style="font-size:2.3em" >').replace('\\)', '</mathjax>')
-        # js_code = f"document.body.innerHTML += '{content_html}'; MathJax.typeset();"
-        # self.text_area.page().runJavaScript(js_code)
-        self.eq_list.append_formula(content)
-
-    def updatePreview(self):
-        formula_str = self.input_box.toPlainText()
-        self.preview.setHtml(self.page_template.format(formula=formula_str), QUrl('file://'))
-
-    def eventFilter(self, obj, event):
-        if obj is self.input_box and event.type() == QEvent.FocusIn:
-            # Clear the input box when it receives focus
-            # self.input_box.setPlainText('')
-            ...
-
-        if event.type() == QEvent.KeyPress and obj is self.input_box:
-            if event.key() == Qt.Key_Return and self.input_box.hasFocus():
-                if event.modifiers() & Qt.ControlModifier:
-                    self.add_current_formula()
-                    return True # this seems to delete the trailing \n.. interesting
-
-        return super().eventFilter(obj, event)
-
-    def add_current_formula(self):
-        formula_str = self.input_box.toPlainText()
-
-        if formula_str:
-            print('appending formula: ', formula_str)
-            self.eq_queue.append(formula_str)
-            print('svg: ', self.formula_svg)
-            self.input_box.clear()
-            self.render.setHtml(self.page_template.format(formula=formula_str),
-                                QUrl('file://'))
-
-    def _on_load_finished(self):
-        # Extract the SVG output from the page and add an XML header
-        xml_header = b'<?xml version="1.0" encoding="utf-8" standalone="no"?>'
-        self.runJavaScript("""
-            var mjelement = document.getElementById('mathjax-container');
-            mjelement.getElementsByTagName('svg')[0].outerHTML;
-        """, lambda result: self.update_svg(xml_header + result.encode()))
-
-    def update_svg(self, svg:bytes):
-        # add XML header
-        formula = self.eq_queue.pop(0)
-        self.eq_list.append_formula_svg(formula, svg)
-
+# page_template is re-exported for benchmark, which compares against the old per-formula page
+__all__ = ['RenderBridge', 'MathJaxRenderer', 'page_template']
+
+
+class RenderBridge(QObject):
+    """Receives results from the engine page's JavaScript over the web channel."""
+    rendered = pyqtSignal(int, str)
+    batchRendered = pyqtSignal(int, list)
+    timed = pyqtSignal(int, list)
+    started = pyqtSignal(str)
+
+    @pyqtSlot(int, str, 'QVariantList')
+    def svgReady(self, job, svg, timings):
+        self.timed.emit(job, timings)
+        self.rendered.emit(job, svg)
+
+    @pyqtSlot(int, 'QVariantList', 'QVariantList')
+    def batchReady(self, job, svgs, timings):
+        self.timed.emit(job, timings)
+        self.batchRendered.emit(job, svgs)
+
+    @pyqtSlot(str)
+    def mathjaxReady(self, version):
+        self.started.emit(version)
+
+
+class MathJaxRenderer(QWebEnginePage):
+    """A long-lived page that loads MathJax once and typesets formulas on demand.
+
+    ``submit`` queues a formula and calls ``callback`` with the SVG bytes (XML header
+    included) once it has been typeset.  ``submit_batch`` does the same for a list of
+    formulas in one JavaScript round trip, calling ``callback`` with a list of SVGs.
+    Formulas submitted before MathJax has finished loading are held back and sent as soon
+    as it is ready.
+
+    ``timed`` reports, per job, a ``[typeset ms, svg extraction ms]`` pair for each formula
+    as measured inside the page.  ``failed`` is emitted if the page's render process dies;
+    its outstanding jobs never complete.
+    """
+    ready = pyqtSignal(str)
+    timed = pyqtSignal(int, list)
+    failed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.mathjax_version = None
+        self.next_job = 0
+        self.callbacks = {}
+        self.waiting = []
+
+        self.bridge = RenderBridge(self)
+        self.bridge.rendered.connect(self._on_rendered)
+        self.bridge.batchRendered.connect(self._on_batch_rendered)
+        self.bridge.timed.connect(self.timed)
+        self.bridge.started.connect(self._on_started)
+        self.channel = QWebChannel(self)
+        self.channel.registerObject('bridge', self.bridge)
+        self.setWebChannel(self.channel)
+        self.renderProcessTerminated.connect(self._on_terminated)
+
+        self.setHtml(engine_page, QUrl('file://'))
+
+    def isReady(self):
+        return self.mathjax_version is not None
+
+    def submit(self, formula:str, callback=None) -> int:
+        return self._queue('mmTypeset', formula, callback)
+
+    def submit_batch(self, formulas:list, callback=None) -> int:
+        return self._queue('mmTypesetBatch', list(formulas), callback)
+
+    def _queue(self, function, argument, callback):
+        job = self.next_job
+        self.next_job += 1
+        self.callbacks[job] = callback
+        call = '{}({}, {});'.format(function, job, json.dumps(argument))
+
+        if self.isReady():
+            self.runJavaScript(call)
+        else:
+            self.waiting.append(call)
+
+        return job
+
+    def _on_started(self, version):
+        logging.debug('MathJax {} ready'.format(version))
+        self.mathjax_version = version
+        waiting, self.waiting = self.waiting, []
+        for call in waiting:
+            self.runJavaScript(call)
+        self.ready.emit(version)
+
+    def _on_rendered(self, job, svg):
+        callback = self.callbacks.pop(job, None)
+        if not svg:
+            logging.error('no svg produced for job {}'.format(job))
+        if callback is not None:
+            callback(xml_header + svg.encode())
+
+    def _on_batch_rendered(self, job, svgs):
+        callback = self.callbacks.pop(job, None)
+        logging.debug('batch {}: {} formulas typeset'.format(job, len(svgs)))
+        if callback is not None:
+            callback([xml_header + svg.encode() for svg in svgs])
+
+    def abandon(self):
+        """Drop every outstanding job; nothing more will be called back."""
+        self.callbacks.clear()
+        self.waiting.clear()
+
+    def _on_terminated(self, status, code):
+        logging.error('render process terminated ({}, exit code {})'.format(status, code))
+        self.failed.emit()
+
+    def javaScriptConsoleMessage(self, level, message, line, source):
+        logging.debug('js: {} ({}:{})'.format(message, source, line))
@@ -0,0 +1,64 @@
+"""In-process rendering with matplotlib's mathtext, for formulas simple enough for it.
+
+mathtext covers a good part of everyday TeX math (scripts, fractions, roots, greek,
+operators, \\left...\\right) and typesets one in a few milliseconds, without a web
+engine.  Anything it can't parse, such as environments, line breaks, \\color or our own
+macros, is left to MathJax.
+"""
+import io, logging, re
+
+# what mathtext draws in, swapped for currentColor in the svg so it can be recolored
+sentinel_color = '#010203'
+# glyphs are drawn 1000pt high so the svg's user units are thousandths of an em, the same
+# units MathJax uses; svg_geometry and the list's row heights then work out the same
+font_size = 1000
+
+size_pattern = re.compile(rb'width="([\d.]+)pt" height="([\d.]+)pt"')
+metadata_pattern = re.compile(rb'\s*<metadata>.*?</metadata>', re.DOTALL)
+
+
+class MathtextRenderer:
+    """Renders formulas to svg on one Figure that is reused for every formula."""
+
+    def __init__(self):
+        import matplotlib
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.font_manager import FontProperties
+        from matplotlib.mathtext import MathTextParser
+
+        matplotlib.rcParams['mathtext.fontset'] = 'cm'
+        # stable ids, so the same formula always gives the same bytes
+        matplotlib.rcParams['svg.hashsalt'] = 'mathmemo'
+
+        self.parser = MathTextParser('path')
+        self.font = FontProperties(size=font_size)
+        self.figure = Figure(dpi=72)
+        FigureCanvasAgg(self.figure)
+        self.text = self.figure.text(0, 0, '', fontproperties=self.font, color=sentinel_color)
+
+    def render(self, formula:str):
+        """Return the svg for ``formula``, or None if mathtext can't handle it."""
+        math = '$' + formula + '$'
+        try:
+            width, height, depth, _, _ = self.parser.parse(math, 72, self.font)
+        except (ValueError, RuntimeError):
+            return None
+        if width <= 0 or height <= 0:
+            return None
+
+        self.figure.set_size_inches(width / 72, height / 72)
+        self.text.set_text(math)
+        self.text.set_position((0, depth / height))
+        buffer = io.BytesIO()
+        try:
+            self.figure.savefig(buffer, format='svg', transparent=True, metadata={'Date': None})
+        except (ValueError, RuntimeError) as e:
+            logging.debug('mathtext failed on %s: %s', formula, e)
+            return None
+
+        svg = metadata_pattern.sub(b'', buffer.getvalue())
+        svg = svg.replace(sentinel_color.encode(), b'currentColor')
+        size = 'width="{:.3f}em" height="{:.3f}em" style="vertical-align: -{:.3f}em"'.format(
+            width / font_size, height / font_size, depth / font_size)
+        return size_pattern.sub(size.encode(), svg, count=1)
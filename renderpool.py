@@ -0,0 +1,104 @@
+import logging, os
+from functools import partial
+from PyQt5.QtCore import QObject, pyqtSignal
+
+backends = ('web', 'node')
+default_backend = os.environ.get('MATHMEMO_BACKEND', 'web')
+
+
+def page_class(backend):
+    # imported here so the node backend never loads QtWebEngine
+    if backend == 'node':
+        from mjnode import NodeRenderer
+        return NodeRenderer
+    elif backend == 'web':
+        from mjrender import MathJaxRenderer
+        return MathJaxRenderer
+    raise ValueError('unknown render backend: {}'.format(backend))
+
+
+class RenderPool(QObject):
+    """Spreads render jobs over several pages so they typeset in parallel.
+
+    A page is a MathJaxRenderer (a QWebEnginePage) or, with the ``node`` backend, a
+    NodeRenderer driving a node process; both load MathJax once and typeset on demand.
+
+    Pages are created on demand: a new one is only started when every existing page is
+    busy, up to ``size`` pages.  Each job goes to the page with the fewest outstanding
+    jobs, unless the caller picks one with ``idle_page``.  Results from different pages can
+    finish in any order, so callers that care about ordering must put the results back in
+    order themselves.  A page that hangs or crashes can be ``discard``ed and a fresh one is
+    started in its place when needed.
+    """
+    default_size = max(1, min(os.cpu_count() or 1, 8))
+    pageFailed = pyqtSignal(object)
+
+    def __init__(self, size=None, parent=None, backend=None):
+        super().__init__(parent)
+        self.size = size or self.default_size
+        self.page_class = page_class(backend or default_backend)
+        self.pages = []
+        self.outstanding = {}
+
+    def start(self):
+        # the first page loads MathJax in the background, ready for the first job
+        if not self.pages:
+            self._add_page()
+
+    def submit(self, formula:str, callback=None, page=None):
+        page = self._page(page)
+        return page, page.submit(formula, partial(self._done, page, callback))
+
+    def submit_batch(self, formulas:list, callback=None, page=None):
+        page = self._page(page)
+        return page, page.submit_batch(formulas, partial(self._done, page, callback))
+
+    def idle_page(self, reserved=0):
+        """A page with nothing to do, starting one if there is room, or None.  Only
+        ``size - reserved`` pages are ever busy at once through this method, so the rest
+        stay free for more urgent work."""
+        busy = sum(1 for page in self.pages if self.outstanding[page])
+        if busy >= self.size - reserved:
+            return None
+        for page in self.pages:
+            if not self.outstanding[page]:
+                return page
+        return self._add_page()
+
+    def discard(self, page):
+        if page in self.outstanding:
+            logging.debug('render pool: discarding page {}'.format(self.pages.index(page) + 1))
+            self.pages.remove(page)
+            del self.outstanding[page]
+            page.abandon()
+            page.deleteLater()
+
+    def _page(self, page=None):
+        if page is not None:
+            self.outstanding[page] += 1
+            return page
+
+        idle = [page for page in self.pages if self.outstanding[page] == 0]
+        if not idle and len(self.pages) < self.size:
+            page = self._add_page()
+        else:
+            page = min(self.pages, key=self.outstanding.get)
+
+        self.outstanding[page] += 1
+        return page
+
+    def _add_page(self):
+        page = self.page_class(self)
+        page.failed.connect(partial(self.pageFailed.emit, page))
+        self.pages.append(page)
+        self.outstanding[page] = 0
+        logging.debug('render pool: started page {} of {}'.format(len(self.pages), self.size))
+        return page
+
+    def _done(self, page, callback, result):
+        if page not in self.outstanding:
+            # a result that raced with the page being discarded
+            return
+        self.outstanding[page] -= 1
+        if callback is not None:
+            callback(result)
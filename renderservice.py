@@ -0,0 +1,260 @@
+"""The application's single renderer: formulas go in, SVGs come back.
+
+The formula list, the preview and anything else that needs a formula typeset share one
+RenderService, so there is one set of MathJax pages (see renderpool.RenderPool) and one
+cache in front of them, and every render is scheduled in the same place.
+"""
+import heapq, itertools, logging
+from concurrent.futures import Future, TimeoutError
+from functools import partial
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from svgcache import SvgCache
+from svgopt import minify
+from texnormalize import canonical
+
+# priority classes, most urgent first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderJob(Future):
+    """A concurrent.futures.Future for one formula, or a batch of them.
+
+    The result is the svg bytes, or a list of them for a batch.  Jobs can be cancelled
+    until they are handed to a page.  From asyncio (e.g. under qasync) a job can be
+    awaited with ``asyncio.wrap_future``; from Qt, RenderService.finished is emitted with
+    every job that completes.
+    """
+
+    def __init__(self, formulas, batch, priority, timeout, order=None):
+        super().__init__()
+        self.formulas = formulas
+        self.batch = batch
+        # for a batch with equivalent formulas, the index in formulas of each one submitted
+        self.order = order
+        self.priority = priority
+        self.timeout = timeout
+        self.page = None
+
+    def count(self):
+        return len(self.order if self.order is not None else self.formulas)
+
+    def expand(self, svgs:list) -> list:
+        return svgs if self.order is None else [svgs[i] for i in self.order]
+
+
+class RenderService(QObject):
+    """Schedules render jobs over the shared pool, remembering results in the svg cache.
+
+    Waiting jobs are started most urgent first, one job per page.  When the pool has more
+    than one page, one is kept free of ``BULK`` work so that typing in the preview isn't
+    stuck behind a session being loaded.  A job that takes longer than its timeout is
+    assumed to have hung its page: the page is thrown away and replaced, and a timed out
+    batch is retried a formula at a time so only the formula at fault fails.
+
+    Formulas are typeset as they were written and cached under their canonical key (see
+    texnormalize), so equivalent spellings share one render, and a batch renders each key
+    once.
+
+    Single formulas that matplotlib's mathtext can handle are typeset in-process (see
+    mtrender) and complete immediately; the choice is logged.  Their svgs aren't cached.
+    Batches always go to the pool, whose pages work in parallel and off the GUI thread.
+
+    Callbacks receive the svg as bytes with an XML header (a list of them for a batch),
+    already minified (see svgopt), which is also how it is cached.  A
+    formula MathJax couldn't typeset, or a job that failed, comes back without an ``<svg``
+    element and isn't cached.  The backend (QtWebEngine or node) is only started when the
+    first job is submitted or ``start`` is called.
+    """
+    finished = pyqtSignal(object)
+
+    # seconds per job, plus a little per formula in a batch
+    default_timeout = 10.0
+    batch_timeout_per_formula = 0.5
+    # typeset single formulas with mathtext when it can handle them
+    fast_path = True
+
+    def __init__(self, pages=None, cache=None, parent=None, backend=None):
+        super().__init__(parent)
+        # maximum number of pages typesetting in parallel, None to size the pool by cpu count
+        self.pages = pages
+        # 'web' or 'node', see renderpool.backends
+        self.backend = backend
+        # False to cache nothing
+        self.cache = cache if cache is not None else SvgCache()
+        self._pool = None
+        self._mathtext = None
+        self.waiting = []
+        self.running = {}
+        self.order = itertools.count()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            from renderpool import RenderPool
+            self._pool = RenderPool(self.pages, self, self.backend)
+            self._pool.pageFailed.connect(self._on_page_failed)
+        return self._pool
+
+    @property
+    def mathtext(self):
+        if self._mathtext is None:
+            from mtrender import MathtextRenderer
+            self._mathtext = MathtextRenderer()
+        return self._mathtext
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    def start(self):
+        """Load MathJax, and matplotlib for the fast path, ahead of the first job."""
+        self.pool.start()
+        if self.fast_path:
+            self.mathtext
+
+    def cached(self, formula:str):
+        svg = self.cache.get(canonical(formula)) if self.cache else None
+        # entries cached before svgs were minified
+        return minify(svg) if svg is not None else None
+
+    def submit(self, formula:str, callback=None, priority=NORMAL, timeout=None) -> RenderJob:
+        job = RenderJob([formula], False, priority, timeout)
+        svg = self._route(formula)
+        if svg is None:
+            return self._submit(job, callback)
+
+        if callback is not None:
+            job.add_done_callback(partial(self._call_back, callback))
+        job.set_running_or_notify_cancel()
+        # not cached: the cache holds MathJax renders only, so a formula looks the same
+        # whichever path reaches it, and mathtext is quick enough to just render again
+        job.set_result(svg)
+        self.finished.emit(job)
+        return job
+
+    def submit_batch(self, formulas:list, callback=None, priority=BULK,
+                     timeout=None) -> RenderJob:
+        keys = [canonical(formula) for formula in formulas]
+        # the first spelling of each key is the one typeset
+        first = {}
+        for formula, key in zip(formulas, keys):
+            first.setdefault(key, formula)
+        unique = {key: i for i, key in enumerate(first)}
+        order = [unique[key] for key in keys] if len(unique) < len(keys) else None
+        return self._submit(RenderJob(list(first.values()), True, priority, timeout, order),
+                            callback)
+
+    def cancel(self, job:RenderJob) -> bool:
+        # a job that is already on a page runs to completion
+        return job.cancel()
+
+    def _route(self, formula):
+        """The mathtext svg for ``formula``, or None if it has to go to MathJax."""
+        if not self.fast_path:
+            return None
+        svg = self.mathtext.render(formula)
+        logging.debug('%s: %s', 'mathjax' if svg is None else 'mathtext', formula)
+        return minify(svg) if svg is not None else None
+
+    def _submit(self, job, callback):
+        if callback is not None:
+            job.add_done_callback(partial(self._call_back, callback))
+        heapq.heappush(self.waiting, (job.priority, next(self.order), job))
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        while self.waiting:
+            priority, _, job = self.waiting[0]
+            if job.cancelled():
+                heapq.heappop(self.waiting)
+                continue
+            reserved = 1 if priority == BULK and self.pool.size > 1 else 0
+            page = self.pool.idle_page(reserved)
+            if page is None:
+                return
+            heapq.heappop(self.waiting)
+            if not job.set_running_or_notify_cancel():
+                continue
+
+            job.page = page
+            self.running[page] = job
+            if job.batch:
+                self.pool.submit_batch(job.formulas, partial(self._rendered, job), page)
+            else:
+                self.pool.submit(job.formulas[0], partial(self._rendered, job), page)
+
+            timeout = job.timeout
+            if timeout is None:
+                timeout = self.default_timeout + \
+                    (self.batch_timeout_per_formula * len(job.formulas) if job.batch else 0)
+            QTimer.singleShot(int(timeout * 1000), partial(self._expired, job, page))
+
+    def _rendered(self, job, result):
+        del self.running[job.page]
+        svgs = [minify(svg) for svg in (result if job.batch else [result])]
+        for formula, svg in zip(job.formulas, svgs):
+            self._store(formula, svg)
+        job.set_result(job.expand(svgs) if job.batch else svgs[0])
+        self.finished.emit(job)
+        self._dispatch()
+
+    def _store(self, formula, svg:bytes):
+        # failed renders come back without an <svg> element and shouldn't be remembered
+        if b'<svg' in svg:
+            if self.cache:
+                self.cache.put(canonical(formula), svg)
+        else:
+            logging.debug('render failed: %s', formula)
+
+    def _expired(self, job, page):
+        if job.done() or self.running.get(page) is not job:
+            return
+        logging.warning('render timed out after %d formulas, restarting the page',
+                        len(job.formulas))
+        self._fail(job, TimeoutError('render timed out'))
+
+    def _on_page_failed(self, page):
+        job = self.running.get(page)
+        if job is not None:
+            self._fail(job, RenderError('render process terminated'))
+        else:
+            self.pool.discard(page)
+
+    def _fail(self, job, error):
+        del self.running[job.page]
+        self.pool.discard(job.page)
+
+        if job.batch and len(job.formulas) > 1:
+            # retry one at a time, with the batch's priority, so only the culprit fails
+            parts = [RenderJob([formula], False, job.priority, job.timeout)
+                     for formula in job.formulas]
+            for part in parts:
+                part.add_done_callback(partial(self._part_done, job, parts))
+                heapq.heappush(self.waiting, (part.priority, next(self.order), part))
+        else:
+            job.set_exception(error)
+            self.finished.emit(job)
+        self._dispatch()
+
+    def _part_done(self, job, parts, part):
+        if job.done() or not all(other.done() for other in parts):
+            return
+        job.set_result(job.expand([other.result() if other.exception() is None else b''
+                                   for other in parts]))
+        self.finished.emit(job)
+
+    @staticmethod
+    def _call_back(callback, job):
+        if job.cancelled():
+            return
+        if job.exception() is not None:
+            callback([b''] * job.count() if job.batch else b'')
+        else:
+            callback(job.result())
@@ -0,0 +1,136 @@
+"""An index for finding formulas by the commands and identifiers in them, or any substring.
+
+A query is split into words.  A control sequence (``\\Ex``) matches formulas using that
+command, and a letter or number shorter than ``trigram`` characters (``x``, ``ab``, ``42``)
+matches that identifier or number.  Both are looked up in an inverted index of terms.
+Any other word matches anywhere in the formula.  Those are found through an index of the
+formulas' three-character substrings: the candidates come from the word's rarest trigram
+and are then checked against the formula itself.  A formula has to match every word.
+
+Postings are flat arrays of keys, so the index costs a few bytes per trigram of text.
+Removing a formula only forgets its text; its stale postings are skipped by the check and
+dropped when the index is rebuilt, once they outnumber the live ones.
+"""
+import re
+from array import array
+
+trigram = 3
+term_pattern = re.compile(r'\\[A-Za-z]+|\\.|[A-Za-z]+|\d+')
+command_pattern = re.compile(r'\\[A-Za-z]+|\\.')
+
+
+def terms(formula:str) -> set:
+    """The control sequences, letter runs, single letters and numbers in ``formula``."""
+    found = set()
+    for term in term_pattern.findall(formula):
+        found.add(term)
+        if term[0] != '\\' and term.isalpha() and len(term) > 1:
+            # TeX reads ab as a times b
+            found.update(term)
+    return found
+
+
+def trigrams(text:str) -> set:
+    return {text[i:i + trigram] for i in range(len(text) - trigram + 1)}
+
+
+class Query:
+    """A parsed query: the terms and substrings a formula needs to match it."""
+
+    def __init__(self, text:str):
+        self.terms = []
+        self.substrings = []
+        for word in text.split():
+            if command_pattern.fullmatch(word) or \
+                    (len(word) < trigram and term_pattern.fullmatch(word)):
+                self.terms.append(word)
+            else:
+                # the commands in it narrow down the candidates
+                self.terms.extend(command_pattern.findall(word))
+                self.substrings.append(word)
+
+    def __bool__(self):
+        return bool(self.terms or self.substrings)
+
+    def matches(self, formula:str) -> bool:
+        if not all(substring in formula for substring in self.substrings):
+            return False
+        return not self.terms or set(self.terms) <= terms(formula)
+
+
+class SearchIndex:
+    """Formulas by integer key, searchable with ``search``.
+
+    Keys are whatever the owner uses to find the formula again, e.g. a row serial.  Results
+    come newest first, in the order the formulas were added.
+    """
+
+    def __init__(self):
+        self.formulas = {}
+        self.term_postings = {}
+        self.trigram_postings = {}
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.formulas)
+
+    def add(self, key:int, formula:str):
+        if key in self.formulas:
+            self.remove(key)
+        self.formulas[key] = formula
+        for postings, words in ((self.term_postings, terms(formula)),
+                                (self.trigram_postings, trigrams(formula))):
+            for word in words:
+                keys = postings.get(word)
+                if keys is None:
+                    postings[word] = array('q', (key,))
+                else:
+                    keys.append(key)
+
+    def add_many(self, items):
+        for key, formula in items:
+            self.add(key, formula)
+
+    def remove(self, key:int):
+        if self.formulas.pop(key, None) is not None:
+            self.stale += 1
+            if self.stale > max(1000, len(self.formulas)):
+                self.rebuild()
+
+    def clear(self):
+        self.__init__()
+
+    def rebuild(self):
+        formulas = self.formulas
+        self.clear()
+        self.add_many(formulas.items())
+
+    def search(self, query, limit=None) -> list:
+        """Return the keys of up to ``limit`` formulas matching ``query``, newest first."""
+        if not isinstance(query, Query):
+            query = Query(query)
+        if not query:
+            return []
+
+        # the smallest posting list gives the candidates; the rest is checked directly
+        lists = [self.term_postings.get(term, ()) for term in query.terms]
+        for substring in query.substrings:
+            if len(substring) >= trigram:
+                lists.append(min((self.trigram_postings.get(gram, ())
+                                  for gram in trigrams(substring)), key=len))
+        # a query of short symbols only (``^2``) has to look at everything
+        candidates = min(lists, key=len) if lists else list(self.formulas)
+
+        # postings are in the order formulas were added, so the newest come first
+        found = []
+        seen = set()
+        for key in reversed(candidates):
+            if key in seen:
+                continue
+            seen.add(key)
+            formula = self.formulas.get(key)
+            if formula is not None and query.matches(formula):
+                found.append(key)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
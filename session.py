@@ -0,0 +1,146 @@
+import logging, os, sqlite3, time
+
+sqlite_header = b'SQLite format 3\0'
+session_suffix = '.mathmemo'
+schema_version = 3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    formula TEXT NOT NULL,
+    svg BLOB,
+    height INTEGER,
+    context TEXT,
+    created REAL,
+    key TEXT
+);
+CREATE TABLE IF NOT EXISTS glyphs (
+    id TEXT PRIMARY KEY,
+    element BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS svgs (
+    key TEXT PRIMARY KEY,
+    svg BLOB NOT NULL
+);
+'''
+
+
+def parse_text_session(text:str) -> list:
+    """Split a text session, one ``\\[formula\\]`` per line, into its formulas."""
+    if not text:
+        return []
+    formula_list = text.split('\\]\n\\[')
+    formula_list[0] = formula_list[0].removeprefix('\\[')
+    formula_list[-1] = formula_list[-1].removesuffix('\\]\n')
+    return formula_list
+
+
+def format_text_session(formulas) -> str:
+    return ''.join('\\[' + formula + '\\]\n' for formula in formulas)
+
+
+def is_session_file(filename) -> bool:
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(sqlite_header)) == sqlite_header
+    except OSError:
+        return False
+
+
+class SessionStore:
+    """A session saved as a single SQLite file.
+
+    Each entry keeps its formula, the rendered svg and its height in the list, the hash of
+    the render context it was rendered with and its creation time.  Since version 2 the
+    svgs are stored without their glyphs, which are kept once for the whole session in the
+    glyphs table (see svgopt.GlyphTable).  Since version 3 entries with the same canonical
+    key (see texnormalize) share one svg in the svgs table.  Rows are read in pages and svgs
+    one at a time, so opening a session costs the same no matter how big it is, and saving
+    only writes what changed since the last save.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.fspath(filename)
+        self.db = sqlite3.connect(self.filename)
+        self.db.executescript(schema)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version < schema_version:
+            # older sessions kept a complete svg in every row, which still load as they are
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(entries)')]
+            if 'key' not in columns:
+                self.db.execute('ALTER TABLE entries ADD COLUMN key TEXT')
+            self.db.execute('PRAGMA user_version = {}'.format(schema_version))
+        elif version > schema_version:
+            logging.warning('{}: session format {} is newer than {}'.format(
+                self.filename, version, schema_version))
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_key ON entries (key)')
+        self.db.commit()
+
+    @classmethod
+    def create(cls, filename):
+        """Start a new, empty session at ``filename``, replacing whatever was there."""
+        if os.path.exists(filename):
+            os.remove(filename)
+        return cls(filename)
+
+    def close(self):
+        self.db.close()
+
+    def count(self) -> int:
+        return self.db.execute('SELECT count(*) FROM entries').fetchone()[0]
+
+    def rows(self, after_id=0, limit=1000) -> list:
+        """Return up to ``limit`` ``(id, formula, height, key)`` rows following ``after_id``."""
+        return self.db.execute('SELECT id, formula, height, key FROM entries WHERE id > ? '
+                               'ORDER BY id LIMIT ?', (after_id, limit)).fetchall()
+
+    def svg(self, entry_id) -> bytes:
+        row = self.db.execute('SELECT coalesce(entries.svg, svgs.svg) FROM entries '
+                              'LEFT JOIN svgs ON svgs.key = entries.key WHERE entries.id = ?',
+                              (entry_id,)).fetchone()
+        return bytes(row[0]) if row and row[0] is not None else None
+
+    def glyphs(self) -> dict:
+        return {glyph_id: bytes(element)
+                for glyph_id, element in self.db.execute('SELECT id, element FROM glyphs')}
+
+    def add_glyphs(self, glyphs:dict):
+        self.db.executemany('INSERT OR IGNORE INTO glyphs (id, element) VALUES (?, ?)',
+                            glyphs.items())
+
+    def append(self, entries, context=None) -> list:
+        """Append ``(formula, svg, height, key)`` entries and return their new ids.
+
+        The svg of an entry with a key is stored once for all the entries with that key.
+        """
+        ids = []
+        now = time.time()
+        for formula, svg, height, key in entries:
+            if key is not None and svg:
+                self.db.execute('INSERT OR IGNORE INTO svgs (key, svg) VALUES (?, ?)', (key, svg))
+                svg = None
+            cursor = self.db.execute('INSERT INTO entries (formula, svg, height, context, created, key) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)',
+                                     (formula, svg, height, context, now, key))
+            ids.append(cursor.lastrowid)
+        return ids
+
+    def delete(self, ids):
+        self.db.executemany('DELETE FROM entries WHERE id = ?', [(i,) for i in ids])
+        if ids:
+            self.db.execute('DELETE FROM svgs WHERE key NOT IN '
+                            '(SELECT key FROM entries WHERE key IS NOT NULL)')
+
+    def commit(self):
+        self.db.commit()
+
+    def copy_to(self, filename):
+        """Write a complete copy of this session to ``filename`` and return a store for it."""
+        self.db.commit()
+        if os.path.exists(filename):
+            os.remove(filename)
+        target = sqlite3.connect(os.fspath(filename))
+        with target:
+            self.db.backup(target)
+        target.close()
+        return SessionStore(filename)
@@ -0,0 +1,176 @@
+"""Several sessions open at once, as tabs over one FormulaList.
+
+Every session is a FormulaModel of its own, but there is only one list view, one
+RenderService and one svg cache: switching tabs swaps the model shown in the list.  The
+session left behind is released (see ``FormulaModel.release``), keeping only what can't be
+had again, i.e. its formulas and the svgs not yet saved, so that sessions in the background
+cost little more than their text.  The sessions also share one search index, so ``search``
+finds formulas in all of them.
+"""
+import os
+from functools import partial
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtWidgets import QTabBar
+from formulalist import FormulaModel
+from searchindex import SearchIndex
+
+
+class SessionTab:
+    """A session open in a tab, and where the list was scrolled to when it was left."""
+    __slots__ = ('model', 'filename', 'source', 'scroll', 'row')
+
+    def __init__(self, model, filename=None):
+        self.model = model
+        # the session file, which autosave compacts into
+        self.filename = filename
+        # the file last opened or saved in the tab, a session or a text file
+        self.source = filename
+        self.scroll = 0
+        self.row = -1
+
+
+class SessionTabs(QTabBar):
+    """Tab bar that shows the session of the current tab in a FormulaList."""
+    currentSessionChanged = pyqtSignal(object)
+    sessionAdded = pyqtSignal(object)
+    sessionClosed = pyqtSignal(object)
+    filenameChanged = pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.formula_list = None
+        self.sessions = []
+        self.shown = None
+        self.untitled = 0
+        # over the formulas of every open session, each under its own number
+        self.search_index = SearchIndex()
+        self.opened = 0
+        self.setTabsClosable(True)
+        self.setMovable(True)
+        self.setDocumentMode(True)
+        self.setExpanding(False)
+        self.currentChanged.connect(self.showSession)
+        self.tabMoved.connect(self.moveSession)
+
+    def setFormulaList(self, formula_list):
+        """Show the sessions in ``formula_list``, whose current model becomes the first tab."""
+        self.formula_list = formula_list
+        self.addSession(formula_list.formula_model)
+
+    def addSession(self, model=None, filename=None) -> SessionTab:
+        """Open a new tab, for ``model`` or an empty session, and make it current."""
+        session = SessionTab(model or FormulaModel(self.formula_list), filename)
+        self.watch(session)
+        self.sessions.append(session)
+        self.sessionAdded.emit(session)
+        index = self.addTab('')
+        self.updateTitle(index)
+        self.setCurrentIndex(index)
+        return session
+
+    def watch(self, session):
+        # the title marks unsaved changes
+        update = partial(self.updateSessionTitle, session)
+        for signal in (session.model.rowsInserted, session.model.rowsRemoved,
+                       session.model.modelReset):
+            signal.connect(update)
+        self.opened += 1
+        session.model.share_index(self.search_index, self.opened)
+
+    def session(self, index=None) -> SessionTab:
+        """The session in tab ``index``, by default the current one."""
+        index = self.currentIndex() if index is None else index
+        return self.sessions[index] if 0 <= index < len(self.sessions) else None
+
+    def search(self, query:str, limit=None) -> list:
+        """Return ``(session, serial)`` for up to ``limit`` rows of the open sessions that
+        match ``query``, newest first (see FormulaModel.search)."""
+        numbers = {}
+        for session in self.sessions:
+            # a session's rows go into the index the first time it is searched
+            session.model.search_index()
+            numbers[session.model.index_number] = session
+        found = []
+        for key in self.search_index.search(query, limit):
+            number, serial = FormulaModel.split_index_key(key)
+            if number in numbers:
+                found.append((numbers[number], serial))
+        return found
+
+    def setFilename(self, filename, index=None):
+        session = self.session(index)
+        session.filename = filename
+        session.source = filename
+        self.updateTitle(self.currentIndex() if index is None else index)
+        self.filenameChanged.emit(session)
+
+    def closeSession(self, index=None):
+        """Close tab ``index`` and its session; the last tab is emptied instead of closed."""
+        index = self.currentIndex() if index is None else index
+        session = self.sessions[index]
+        if len(self.sessions) == 1:
+            self.sessions[index] = SessionTab(FormulaModel(self.formula_list))
+            self.watch(self.sessions[index])
+            self.sessionAdded.emit(self.sessions[index])
+            self.showSession(index)
+            self.updateTitle(index)
+        else:
+            # removing the current tab makes another current, shown through showSession
+            del self.sessions[index]
+            if session is self.shown:
+                self.shown = None
+            self.removeTab(index)
+        session.model.unindex()
+        self.sessionClosed.emit(session)
+        if session.model.store is not None:
+            session.model.store.close()
+            session.model.store = None
+            session.model.more = False
+        # renders still on their way hold on to the model until they are done with it
+        session.model.setParent(None)
+
+    def showSession(self, index):
+        session = self.session(index)
+        if session is None or session is self.shown or self.formula_list is None:
+            return
+
+        if self.shown is not None and self.shown is not session:
+            # remember the place in the one being left, then let go of what it can re-read
+            self.shown.scroll = self.formula_list.verticalScrollBar().value()
+            self.shown.row = self.formula_list.currentIndex().row()
+            self.shown.model.release()
+        self.shown = session
+
+        self.formula_list.setFormulaModel(session.model)
+        # a released session reads its rows in again, as far as it had got
+        while session.model.rowCount() <= session.row and session.model.canFetchMore():
+            session.model.fetchMore()
+        if session.row >= 0 and session.row < session.model.rowCount():
+            self.formula_list.setCurrentIndex(session.model.index(session.row))
+        self.formula_list.verticalScrollBar().setValue(session.scroll)
+        self.currentSessionChanged.emit(session)
+
+    def moveSession(self, old, new):
+        self.sessions.insert(new, self.sessions.pop(old))
+
+    def updateSessionTitle(self, session, *args):
+        if session in self.sessions:
+            self.updateTitle(self.sessions.index(session))
+
+    def updateTitles(self):
+        for index in range(self.count()):
+            self.updateTitle(index)
+
+    def updateTitle(self, index):
+        session = self.sessions[index]
+        if session.filename:
+            title = os.path.basename(session.filename)
+        else:
+            if not self.tabData(index):
+                self.untitled += 1
+                self.setTabData(index, self.untitled)
+            title = 'Untitled {}'.format(self.tabData(index))
+        if session.model.isModified():
+            title += ' *'
+        self.setTabText(index, title)
+        self.setTabToolTip(index, session.filename or '')
@@ -0,0 +1,103 @@
+import hashlib, logging, os
+from mjpage import render_context
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'mathmemo', 'svg')
+
+
+class SvgCache:
+    """Content-addressed on-disk store of rendered formulas.
+
+    Entries are keyed by a hash of the formula together with ``mjpage.render_context``
+    (macros, MathJax config and version), so changing any of those simply misses the old
+    entries.  The cache is capped at ``max_bytes``; when it grows past that the least
+    recently used entries, as tracked by file mtime, are evicted.
+    """
+    default_max_bytes = 64 * 1024 * 1024
+
+    def __init__(self, directory=None, max_bytes=None, context=render_context):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes or self.default_max_bytes
+        self.context_hash = hashlib.sha256(context.encode()).hexdigest()
+        self.index = None
+        self.total_bytes = 0
+
+    def key(self, formula:str) -> str:
+        return hashlib.sha256((self.context_hash + '\0' + formula).encode()).hexdigest()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.svg')
+
+    def get(self, formula:str):
+        key = self.key(formula)
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                svg = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+
+        self._load_index()
+        if key in self.index:
+            self.index[key] = (self.index[key][0], os.path.getmtime(path))
+        return svg
+
+    def put(self, formula:str, svg:bytes):
+        key = self.key(formula)
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(svg)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logging.error('svg cache: could not write {}: {}'.format(path, error))
+            return
+
+        self._load_index()
+        old_size, _ = self.index.get(key, (0, 0))
+        self.index[key] = (len(svg), os.path.getmtime(path))
+        self.total_bytes += len(svg) - old_size
+        self._evict()
+
+    def _load_index(self):
+        # the directory is only scanned once, the first time the cache is touched
+        if self.index is not None:
+            return
+
+        self.index = {}
+        self.total_bytes = 0
+        try:
+            subdirs = os.scandir(self.directory)
+        except OSError:
+            return
+
+        with subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                for entry in os.scandir(subdir.path):
+                    if not entry.name.endswith('.svg'):
+                        continue
+                    stat = entry.stat()
+                    self.index[entry.name[:-len('.svg')]] = (stat.st_size, stat.st_mtime)
+                    self.total_bytes += stat.st_size
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        for key, (size, _) in sorted(self.index.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            del self.index[key]
+            self.total_bytes -= size
+            logging.debug('svg cache: evicted {}'.format(key))
@@ -0,0 +1,127 @@
+"""Shrinking rendered svgs, and sharing their glyphs between formulas.
+
+Both MathJax and mathtext draw every character as a ``<use>`` of a glyph ``<path>`` in the
+svg's ``<defs>``, so most of a formula's svg is glyph outlines it shares with every other
+formula in the session.  ``minify`` trims an svg without changing how it draws, and a
+GlyphTable keeps one copy of each glyph for all the formulas it has split, leaving each
+with only its layout (the "body").  ``GlyphTable.join`` puts the glyphs a body uses back,
+for anything that leaves the application: the clipboard, exports and rasterizing.
+"""
+import re
+
+header_pattern = re.compile(rb'^(<\?xml[^>]*\?>)?\s*(<!DOCTYPE[^>]*>)?\s*')
+comment_pattern = re.compile(rb'<!--.*?-->', re.DOTALL)
+# whitespace between tags, but not the content of a <text>
+space_pattern = re.compile(rb'>\s+<(?!/text)')
+data_pattern = re.compile(rb'\s+data-[\w-]+="[^"]*"')
+empty_pattern = re.compile(rb'<(path|use|rect|line)\b([^>]*?)>\s*</\1>')
+# MathJax numbers its glyph ids per document (MJX-12-TEX-I-1D465); the glyph is the same
+mathjax_id_pattern = re.compile(rb'MJX-\d+-TEX-')
+number_attribute_pattern = re.compile(rb'\s(d|transform|viewBox|points)="([^"]*)"')
+number_pattern = re.compile(rb'-?\d*\.\d+')
+path_space_pattern = re.compile(rb'\s*([MmLlHhVvCcSsQqTtAaZz])\s*')
+id_pattern = re.compile(rb'\sid="([^"]+)"')
+reference_pattern = re.compile(rb'href="#([^"]+)"')
+glyph_pattern = re.compile(rb'<path\b[^>]*?\sid="([^"]+)"[^>]*/>')
+empty_defs_pattern = re.compile(rb'<defs>\s*</defs>')
+root_pattern = re.compile(rb'<svg\b[^>]*>')
+
+# decimal places kept in coordinates, whose units are a thousandth of an em or smaller;
+# factors below 1 (scales) keep significant digits instead
+precision = 3
+significant = 4
+
+
+def _round(match):
+    number = float(match.group())
+    if abs(number) < 1:
+        rounded = '{:.{}g}'.format(number, significant)
+    else:
+        rounded = '{:.{}f}'.format(number, precision).rstrip('0').rstrip('.')
+    if float(rounded) == 0:
+        return b'0'
+    return rounded.replace('0.', '.', 1).encode() if rounded.lstrip('-').startswith('0.') \
+        else rounded.encode()
+
+
+def _numbers(match):
+    name, value = match.groups()
+    value = number_pattern.sub(_round, value)
+    if name == b'd':
+        value = path_space_pattern.sub(rb'\1', value).strip()
+    return b' ' + name + b'="' + value + b'"'
+
+
+def minify(svg:bytes) -> bytes:
+    """Return ``svg`` without comments, layout whitespace, data- attributes, unused ids and
+    unused glyphs, and with its numbers rounded (see ``precision``).  The XML header is kept.
+
+    Anything that isn't an svg (a failed render) is returned as it is.
+    """
+    if b'<svg' not in svg:
+        return svg
+
+    header = header_pattern.match(svg).group(1) or b''
+    svg = svg[header_pattern.match(svg).end():]
+    svg = comment_pattern.sub(b'', svg)
+    svg = space_pattern.sub(b'><', svg).strip()
+    svg = data_pattern.sub(b'', svg)
+    svg = empty_pattern.sub(rb'<\1\2/>', svg)
+    svg = mathjax_id_pattern.sub(b'MJX-TEX-', svg)
+    svg = number_attribute_pattern.sub(_numbers, svg)
+
+    # glyphs nothing refers to go, and so do the ids of everything else nothing refers to
+    used = set(reference_pattern.findall(svg))
+    svg = glyph_pattern.sub(lambda m: m.group() if m.group(1) in used else b'', svg)
+    svg = id_pattern.sub(lambda m: m.group() if m.group(1) in used else b'', svg)
+    svg = empty_defs_pattern.sub(b'', svg)
+    return header + svg
+
+
+def root_only(svg:bytes) -> bytes:
+    """Just the root ``<svg>`` element of ``svg``, enough to read its size and view box."""
+    root = root_pattern.search(svg)
+    return root.group() + b'</svg>' if root else svg
+
+
+class GlyphTable:
+    """Glyph ``<path>`` elements by id, shared by the bodies split against the table.
+
+    A glyph whose id is already in the table with different outlines is left in the body
+    it came with, so joining never draws the wrong glyph.
+    """
+
+    def __init__(self, glyphs=None):
+        # id -> the glyph's complete <path .../> element
+        self.glyphs = dict(glyphs or {})
+
+    def __len__(self):
+        return len(self.glyphs)
+
+    def split(self, svg:bytes) -> bytes:
+        """Move the glyphs out of ``svg`` into the table and return what is left."""
+        if not svg or b'<defs' not in svg:
+            return svg
+
+        def take(match):
+            glyph_id, element = match.group(1).decode(), match.group()
+            known = self.glyphs.setdefault(glyph_id, element)
+            return b'' if known == element else element
+
+        return empty_defs_pattern.sub(b'', glyph_pattern.sub(take, svg))
+
+    def join(self, body:bytes) -> bytes:
+        """Return ``body`` as a standalone svg, with the glyphs it uses from the table."""
+        if not body:
+            return body
+
+        defined = set(glyph_pattern.findall(body))
+        missing = [glyph_id for glyph_id in dict.fromkeys(reference_pattern.findall(body))
+                   if glyph_id not in defined and glyph_id.decode() in self.glyphs]
+        if not missing:
+            return body
+
+        defs = b'<defs>' + b''.join(self.glyphs[glyph_id.decode()] for glyph_id in missing) + \
+            b'</defs>'
+        root = root_pattern.search(body)
+        return body[:root.end()] + defs + body[root.end():]
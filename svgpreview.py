@@ -0,0 +1,95 @@
+from PyQt5.QtCore import Qt, QPointF, QTimer
+from PyQt5.QtGui import QPainter, QPalette
+from PyQt5.QtWidgets import QWidget
+from svgraster import formula_hash, svg_geometry, padded_size, svg_pixmap
+from renderservice import INTERACTIVE
+
+
+class SvgPreview(QWidget):
+    """Live preview of the formula being typed, rendered by the application's RenderService.
+
+    ``setFormula`` may be called on every keystroke: calls are coalesced over
+    ``debounce_ms`` and only the latest formula is rendered.  At most one render is in
+    flight at a time; whatever arrives meanwhile is sent when it comes back.  Formulas that
+    fail to render leave the last good preview up.
+    """
+    default_debounce_ms = 150
+    # largest scale the formula is drawn at, relative to the svg's default size
+    max_scale = 2.3
+    margin = 8
+
+    def __init__(self, parent=None, debounce_ms=None):
+        super().__init__(parent)
+        self.service = None
+        self.formula = ''
+        self.sent_formula = None
+        self.in_flight = False
+        self.svg = None
+        self.key = None
+        self.geometry = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.default_debounce_ms if debounce_ms is None else debounce_ms)
+        self.timer.timeout.connect(self._send)
+
+        palette = self.palette()
+        palette.setColor(QPalette.Window, Qt.white)
+        self.setPalette(palette)
+        self.setAutoFillBackground(True)
+
+    def setRenderService(self, service):
+        self.service = service
+
+    def setDebounce(self, msec:int):
+        self.timer.setInterval(msec)
+
+    def setFormula(self, formula:str):
+        self.formula = formula
+        self.timer.start()
+
+    def setSvg(self, svg:bytes):
+        self.svg = svg
+        self.key = formula_hash(svg) if svg else None
+        self.geometry = svg_geometry(svg) if svg else None
+        self.update()
+
+    def _send(self):
+        if self.service is None or self.in_flight or self.formula == self.sent_formula:
+            return
+
+        self.sent_formula = self.formula
+        if not self.formula:
+            self.setSvg(None)
+            return
+        svg = self.service.cached(self.formula)
+        if svg is not None:
+            self.setSvg(svg)
+            return
+
+        self.in_flight = True
+        self.service.submit(self.formula, self._on_rendered, INTERACTIVE)
+
+    def _on_rendered(self, svg:bytes):
+        self.in_flight = False
+        if b'<svg' in svg:
+            self.setSvg(svg)
+        # the user kept typing while this one was rendering
+        self._send()
+
+    def paintEvent(self, event):
+        if not self.svg:
+            return
+        natural = padded_size(self.geometry, 0)
+        if natural.isEmpty():
+            return
+        width = max(1, self.width() - 2 * self.margin)
+        height = max(1, self.height() - 2 * self.margin)
+        scale = round(min(self.max_scale, width / natural.width(), height / natural.height()), 3)
+        dpr = self.devicePixelRatioF()
+        pixmap = svg_pixmap(self.svg, self.key, 'black', scale, dpr)
+
+        size = pixmap.size() / dpr
+        painter = QPainter(self)
+        painter.drawPixmap(QPointF((self.width() - size.width()) / 2,
+                                   (self.height() - size.height()) / 2), pixmap)
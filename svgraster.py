@@ -0,0 +1,76 @@
+import hashlib
+from PyQt5.QtCore import Qt, QRectF, QSize, QSizeF
+from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap, QPixmapCache
+from PyQt5.QtSvg import QSvgRenderer
+
+# QPixmapCache evicts by memory use, least recently used first
+cache_limit_kb = 64 * 1024
+QPixmapCache.setCacheLimit(cache_limit_kb)
+
+# extra view box units added above and below a formula when it is shown in the list
+list_padding = 200
+
+
+def formula_hash(svg:bytes) -> str:
+    return hashlib.sha1(svg).hexdigest()
+
+
+def svg_geometry(svg:bytes):
+    """Return the default size and view box of ``svg``."""
+    renderer = QSvgRenderer(svg)
+    return renderer.defaultSize(), renderer.viewBoxF()
+
+
+def padded_size(geometry, padding=0) -> QSizeF:
+    # padding the view box grows the default size in proportion, so the formula itself is
+    # drawn at the same size with empty space above and below it
+    size, view_box = geometry
+    if not padding or view_box.height() <= 0:
+        return QSizeF(size)
+    return QSizeF(size.width(), size.height() * (view_box.height() + 2 * padding) / view_box.height())
+
+
+def pixmap_key(key, color='black', scale=1.0, dpr=1.0, background=Qt.transparent, padding=0):
+    """The QPixmapCache key svg_pixmap uses, e.g. to remove a pixmap from the cache."""
+    return 'mathmemo:{}:{}:{:.3f}:{}:{}:{}'.format(key, color, scale, dpr, padding,
+                                                 QColor(background).name(QColor.HexArgb))
+
+
+def svg_pixmap(svg:bytes, key=None, color='black', scale=1.0, dpr=1.0, background=Qt.transparent,
+               padding=0) -> QPixmap:
+    """Rasterize ``svg`` with ``currentColor`` set to ``color``, through the pixmap cache.
+
+    ``scale`` is relative to the svg's default size and ``dpr`` is the device pixel ratio of
+    the target.  ``key`` identifies the svg, normally its ``formula_hash``, and is computed
+    when omitted.  ``svg`` can also be a function returning the bytes, called only when the
+    pixmap isn't cached; ``key`` is required then.  Cached pixmaps are shared by everything
+    that asks for the same key, color, scale, device pixel ratio, background and padding.
+    """
+    key = key or formula_hash(svg)
+    background = QColor(background)
+    cache_key = pixmap_key(key, color, scale, dpr, background, padding)
+    pixmap = QPixmapCache.find(cache_key)
+    if pixmap is not None:
+        return pixmap
+
+    if callable(svg):
+        svg = svg()
+    renderer = QSvgRenderer(svg.replace(b'currentColor', color.encode()))
+    renderer.setAspectRatioMode(Qt.KeepAspectRatio)
+    size = padded_size((renderer.defaultSize(), renderer.viewBoxF()), padding) * scale * dpr
+    if padding:
+        renderer.setViewBox(renderer.viewBoxF().adjusted(0, -padding, 0, padding))
+
+    pixmap = QPixmap(QSize(max(1, round(size.width())), max(1, round(size.height()))))
+    pixmap.fill(background)
+    painter = QPainter(pixmap)
+    renderer.render(painter, QRectF(pixmap.rect()))
+    painter.end()
+    pixmap.setDevicePixelRatio(dpr)
+
+    QPixmapCache.insert(cache_key, pixmap)
+    return pixmap
+
+
+def svg_image(svg:bytes, key=None, color='black', scale=1.0, background=Qt.white) -> QImage:
+    return svg_pixmap(svg, key, color, scale, background=background).toImage()
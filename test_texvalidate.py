@@ -0,0 +1,27 @@
+from texvalidate import classify, COMPLETE, RECOVERABLE, BROKEN
+
+
+def test_complete_and_broken():
+    assert classify(r'\frac{a}{b}') == (COMPLETE, r'\frac{a}{b}')
+    assert classify('a}')[0] == BROKEN
+
+
+def test_closers_after_open_comment():
+    # the closers go on a new line, where the comment doesn't reach them
+    state, recovered = classify('x^{a % note')
+    assert state == RECOVERABLE
+    assert recovered == 'x^{a % note\n}'
+    assert classify(recovered)[0] == COMPLETE
+
+
+def test_closers_after_closed_comment():
+    assert classify('x^{a % note\nb') == (RECOVERABLE, 'x^{a % note\nb}')
+    # an escaped % starts no comment
+    assert classify(r'x^{50\%') == (RECOVERABLE, r'x^{50\%}')
+
+
+def test_closers_after_trailing_backslash():
+    # \left\ is the start of a delimiter like \left\{
+    state, recovered = classify('\\left\\')
+    assert state == RECOVERABLE
+    assert classify(recovered)[0] == COMPLETE
@@ -0,0 +1,178 @@
+"""Canonical keys for formulas, so that formulas that typeset the same share one render.
+
+``canonical`` rewrites a formula into a standard spelling of the same TeX:
+
+- whitespace and comments go, except inside text arguments (``\\text{a b}``), the first
+  argument of a command it doesn't know (``\\tag{eq one}``) and ``\\verb``, and where a
+  space ends a command name (``\\alpha b``)
+- arguments are always braced: ``\\frac a b``, ``\\frac{a}{b}`` and ``\\frac{ a }{ b }``
+  are all ``\\frac{a}{b}``, and ``x^2`` is ``x^{2}``
+- redundant braces go: ``{{x}}`` is ``{x}`` and a lone letter or digit in braces, outside
+  an argument, loses them
+- macros that MathJax draws identically are spelled one way (``\\le`` is ``\\leq``)
+
+The key is what svgs are cached and stored under; what gets rendered is the formula as it
+was written, so a key only has to tell apart formulas that typeset differently.
+"""
+from functools import lru_cache
+from texvalidate import tokenize, arity
+
+# alternative spellings of the same symbol, to the spelling used in keys
+aliases = {
+    r'\le': r'\leq', r'\ge': r'\geq', r'\ne': r'\neq', r'\to': r'\rightarrow',
+    r'\gets': r'\leftarrow', r'\lbrace': r'\{', r'\rbrace': r'\}', r'\land': r'\wedge',
+    r'\lor': r'\vee', r'\lnot': r'\neg', r'\owns': r'\ni', r'\vert': '|', r'\Vert': r'\|',
+    r'\thinspace': r'\,', r'\medspace': r'\:', r'\thickspace': r'\;', r'\negthinspace': r'\!',
+}
+
+# commands whose argument is text, where spaces count and are kept as they are
+text_commands = {r'\text', r'\textbf', r'\textit', r'\textrm', r'\textsf', r'\texttt',
+                 r'\mbox', r'\hbox'}
+
+
+class _Reader:
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.tokens = list(tokenize(formula))
+        self.i = 0
+        self.out = []
+
+    def skip_space(self):
+        while self.i < len(self.tokens) and self.tokens[self.i][0] in ('space', 'comment'):
+            self.i += 1
+
+    def peek(self):
+        self.skip_space()
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def emit(self, text):
+        # a command name only ends at a non-letter, so keep a space before any letter
+        if self.out and text[:1].isalpha():
+            last = self.out[-1]
+            if last[:1] == '\\' and last[-1:].isalpha():
+                self.out.append(' ')
+        self.out.append(text)
+
+    def read(self):
+        while self.peek() is not None:
+            self.atom()
+        return ''.join(self.out)
+
+    def group(self):
+        """Read a ``{...}`` group, the open brace being next, into a list of pieces."""
+        out, self.out = self.out, []
+        self.i += 1
+        while self.peek() is not None and self.peek()[0] != 'close':
+            self.atom()
+        closed = self.peek() is not None
+        self.i += closed
+        pieces, self.out = self.out, out
+        return pieces, closed
+
+    def atom(self, argument=False):
+        kind, start, end, text = self.tokens[self.i]
+        if kind == 'open':
+            pieces, closed = self.group()
+            # {{...}} is {...}; a lone letter or digit outside an argument needs no braces
+            if len(pieces) >= 2 and pieces[0] == '{' and self._balanced(pieces[1:-1]) \
+                    and pieces[-1] == '}' and closed:
+                pieces = pieces[1:-1]
+            if not argument and closed and len(pieces) == 1 and len(pieces[0]) == 1 \
+                    and pieces[0].isalnum():
+                self.emit(pieces[0])
+                return
+            self.emit('{')
+            self.out.extend(pieces)
+            if closed:
+                self.out.append('}')
+            return
+
+        self.i += 1
+        if kind == 'command':
+            text = aliases.get(text, text)
+            self.emit(text)
+            if text in (r'\verb', r'\verb*'):
+                self.verbatim_delimited(end)
+            elif text in text_commands and self.peek() is not None and self.peek()[0] == 'open':
+                self.verbatim_group()
+            elif text in arity:
+                if text == r'\sqrt':
+                    self.optional()
+                for _ in range(arity[text]):
+                    self.argument()
+            elif self.peek() is not None and self.peek()[0] == 'open':
+                # a command it doesn't know, whose argument may be text where spaces count
+                self.verbatim_group()
+        elif kind == 'script':
+            self.emit(text)
+            self.argument()
+        else:
+            self.emit(text)
+
+    @staticmethod
+    def _balanced(pieces):
+        depth = 0
+        for piece in pieces:
+            depth += (piece == '{') - (piece == '}')
+            if depth < 0:
+                return False
+        return depth == 0
+
+    def argument(self):
+        token = self.peek()
+        if token is None:
+            return
+        kind, _, _, text = token
+        if kind == 'close':
+            # missing, as in x^}
+            return
+        if kind == 'open':
+            self.atom(argument=True)
+        elif kind in ('char', 'escape') or (kind == 'command' and text not in arity and
+                                            text not in (r'\begin', r'\left')):
+            self.i += 1
+            self.out.append('{')
+            self.out.append(aliases.get(text, text))
+            self.out.append('}')
+        else:
+            self.atom()
+
+    def optional(self):
+        token = self.peek()
+        if token is None or token[3] != '[':
+            return
+        self.emit('[')
+        self.i += 1
+        while self.peek() is not None and self.peek()[3] != ']':
+            self.atom()
+        if self.peek() is not None:
+            self.i += 1
+            self.out.append(']')
+
+    def verbatim_delimited(self, start):
+        # \verb|...|: the character after the name delimits the argument
+        if start >= len(self.formula):
+            return
+        close = self.formula.find(self.formula[start], start + 1)
+        end = len(self.formula) if close < 0 else close + 1
+        while self.i < len(self.tokens) and self.tokens[self.i][1] < end:
+            self.i += 1
+        self.out.append(self.formula[start:end])
+
+    def verbatim_group(self):
+        start = self.tokens[self.i][1]
+        depth = 0
+        while self.i < len(self.tokens):
+            kind = self.tokens[self.i][0]
+            self.i += 1
+            depth += (kind == 'open') - (kind == 'close')
+            if depth == 0:
+                break
+        self.out.append(self.formula[start:self.tokens[self.i - 1][2]])
+
+
+@lru_cache(maxsize=4096)
+def canonical(formula:str) -> str:
+    """The canonical key of ``formula``."""
+    return _Reader(formula).read()
@@ -4,7 +4,7 @@ import sys
 
 # from PySide2 import QtCore, QtGui, QtWidgets
 from PyQt5.QtGui import QSyntaxHighlighter, QTextDocument, QTextCharFormat, QColor, QFont
-from PyQt5.QtCore import QRegExp
+import re
 
 def format(color, style=''):
     """Return a QTextCharFormat with the given attributes.
@@ -53,185 +53,70 @@ STYLES = {
 
 
 class LatexHighlighter (QSyntaxHighlighter):
-    """Syntax highlighter for the Python language.
-    """
-    # Python keywords
-    keywords = [
-        'and', 'assert', 'break', 'class', 'continue', 'def',
-        'del', 'elif', 'else', 'except', 'exec', 'finally',
-        'for', 'from', 'global', 'if', 'import', 'in',
-        'is', 'lambda', 'not', 'or', 'pass', 'print',
-        'raise', 'return', 'try', 'while', 'yield',
-        'None', 'True', 'False',
-    ]
-
-    # Python operators
-    oldoperators = [
-        '=',
-        # Comparison
-        '==', '!=', '<', '<=', '>', '>=',
-        # Arithmetic
-        '\+', '-', '\*', '/', '//', '\%', '\*\*',
-        # In-place
-        '\+=', '-=', '\*=', '/=', '\%=',
-        # Bitwise
-        '\^', '\|', '\&', '\~', '>>', '<<',
-    ]
-
+    """Syntax highlighter for LaTeX formulas.
 
-    operators = [
-        r'\\[A-Za-z]+',
-    ]
-
-    variables = [
-        r'[^\\0-9A-Za-z]([A-Za-z]+)',
-        r'^([A-Za-z]+)',
-        #r'[A-Za-z]+',
-    ]
-
-    comment = [
-       r'%.*$'
-    ]
+    Each block is tokenized in a single pass of one combined regular expression.  The
+    brace and environment nesting at the end of a block is kept as the block state, so
+    when an edit doesn't change the nesting Qt only re-highlights the edited block, and
+    otherwise only the blocks after it until the nesting is back in step.
+    """
 
-    braces = [
-        r'\\{', r'\\}', r'\(', r'\)', r'\[', r'\]',
+    # (token, pattern, style).  Alternatives are tried in order at each position, so
+    # escapes come before the characters they escape.
+    tokens = [
+        ('begin', r'\\begin\s*\{[^{}]*\}', 'operator'),
+        ('end', r'\\end\s*\{[^{}]*\}', 'operator'),
+        ('command', r'\\[A-Za-z]+', 'operator'),
+        ('brace', r'\\[{}]', 'brace'),
+        ('escape', r'\\.', None),
+        ('comment', r'%.*', 'comment'),
+        ('open', r'\{', None),
+        ('close', r'\}', None),
+        ('brace', r'[()\[\]]', 'brace'),
+        ('supersub', r'[_^]', 'supersub'),
+        ('numbers', r'[0-9]*\.[0-9]+|[0-9]+', 'numbers'),
+        ('variables', r'[A-Za-z]+', 'variables'),
     ]
 
-    group= [
-        # groups in TeX are denoted by unescaped curly braces {}
-        r'(?<!\\)\{', r'(?<!\\)\}',
-    ]
+    scanner = re.compile('|'.join('(?P<{}{}>{})'.format(name, i, pattern)
+                                  for i, (name, pattern, _) in enumerate(tokens)))
 
-    supersub= [
-        r'_', r'\^',
-    ]
+    # block state layout: brace depth in the low 16 bits, environment depth above that
+    depth_bits = 16
+    depth_mask = (1 << depth_bits) - 1
 
     def __init__(self, parent: QTextDocument) -> None:
         super().__init__(parent)
+        self.groups = {'{}{}'.format(name, i): (name, STYLES[style] if style else None)
+                       for i, (name, _, style) in enumerate(self.tokens)}
 
-        # Multi-line strings (expression, flag, style)
-        self.tri_single = (QRegExp("'''"), 1, STYLES['string2'])
-        self.tri_double = (QRegExp('"""'), 2, STYLES['string2'])
-
-        rules = []
-
-        # Keyword, operator, and brace rules
-        # rules += [(r'\b%s\b' % w, 0, STYLES['keyword'])
-        #     for w in LatexHighlighter.keywords]
-        rules += [(r'%s' % o, 0, STYLES['operator'])
-            for o in LatexHighlighter.operators]
-        rules += [(r'%s' % b, 0, STYLES['brace'])
-            for b in LatexHighlighter.braces]
-        rules += [(r'%s' % s, 0, STYLES['supersub'])
-                  for s in LatexHighlighter.supersub]
-        rules += [(r'%s' % v, 1, STYLES['variables'])
-                  for v in LatexHighlighter.variables]
-
-        # All other rules
-        rules += [
-            # Numeric literals
-            (r'[0-9]*\.[0-9]+', 0, STYLES['numbers']),
-            (r'[0-9]+', 0, STYLES['numbers']),
-            #(r'\b[+-]?[0-9]+[lL]?\b', 0, STYLES['numbers']),
-            #(r'\b[+-]?0[xX][0-9A-Fa-f]+[lL]?\b', 0, STYLES['numbers']),
-            #(r'\b[+-]?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?\b', 0, STYLES['numbers']),
-        ]
-        """
-        rules += [
-            # 'self'
-            (r'\bself\b', 0, STYLES['self']),
-
-            # 'def' followed by an identifier
-            (r'\bdef\b\s*(\w+)', 1, STYLES['defclass']),
-            # 'class' followed by an identifier
-            (r'\bclass\b\s*(\w+)', 1, STYLES['defclass']),
-
-            # Numeric literals
-            (r'\[0-9]+', 0, STYLES['numbers']),
-            (r'\b[+-]?[0-9]+[lL]?\b', 0, STYLES['numbers']),
-            (r'\b[+-]?0[xX][0-9A-Fa-f]+[lL]?\b', 0, STYLES['numbers']),
-            (r'\b[+-]?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?\b', 0, STYLES['numbers']),
-
+    @classmethod
+    def unpack_state(cls, state):
+        if state < 0:
+            return 0, 0
+        return state & cls.depth_mask, state >> cls.depth_bits
 
-            # Double-quoted string, possibly containing escape sequences
-            (r'"[^"\\]*(\\.[^"\\]*)*"', 0, STYLES['string']),
-            # Single-quoted string, possibly containing escape sequences
-            (r"'[^'\\]*(\\.[^'\\]*)*'", 0, STYLES['string']),
-
-            # From '#' until a newline
-            (r'#[^\n]*', 0, STYLES['comment']),
-        ]
-
-        """
-
-        # Build a QRegExp for each pattern
-        self.rules = [(QRegExp(pat), index, fmt)
-            for (pat, index, fmt) in rules]
+    @classmethod
+    def pack_state(cls, braces, environments):
+        return (environments << cls.depth_bits) | min(braces, cls.depth_mask)
 
     def highlightBlock(self, text):
         """Apply syntax highlighting to the given block of text.
         """
-        self.tripleQuoutesWithinStrings = []
-        # Do other syntax formatting
-        for expression, nth, format in self.rules:
-            index = expression.indexIn(text, 0)
-
-            if expression.pattern() == r'(?!\\)[A-Za-z]+':
-                ...
-            while index >= 0:
-
-                # We actually want the index of the nth match
-                index = expression.pos(nth)
-                length = len(expression.cap(nth))
-                self.setFormat(index, length, format)
-                index = expression.indexIn(text, index + length)
-
-        self.setCurrentBlockState(0)
-
-        # Do multi-line strings
-        #in_multiline = self.match_multiline(text, *self.tri_single)
-        #if not in_multiline:
-            #in_multiline = self.match_multiline(text, *self.tri_double)
-
-    def match_multiline(self, text, delimiter, in_state, style):
-        """Do highlighting of multi-line strings. ``delimiter`` should be a
-        ``QRegExp`` for triple-single-quotes or triple-double-quotes, and
-        ``in_state`` should be a unique integer to represent the corresponding
-        state changes when inside those strings. Returns True if we're still
-        inside a multi-line string when this function is finished.
-        """
-        # If inside triple-single quotes, start at 0
-        if self.previousBlockState() == in_state:
-            start = 0
-            add = 0
-        # Otherwise, look for the delimiter on this line
-        else:
-            start = delimiter.indexIn(text)
-            # skipping triple quotes within strings
-            if start in self.tripleQuoutesWithinStrings:
-                return False
-            # Move past this match
-            add = delimiter.matchedLength()
-
-        # As long as there's a delimiter match on this line...
-        while start >= 0:
-            # Look for the ending delimiter
-            end = delimiter.indexIn(text, start + add)
-            # Ending delimiter on this line?
-            if end >= add:
-                length = end - start + add + delimiter.matchedLength()
-                self.setCurrentBlockState(0)
-            # No; multi-line string
-            else:
-                self.setCurrentBlockState(in_state)
-                length = len(text) - start + add
-            # Apply formatting
-            self.setFormat(start, length, style)
-            # Look for the next match
-            start = delimiter.indexIn(text, start + length)
-
-        # Return True if still inside a multi-line string, False otherwise
-        if self.currentBlockState() == in_state:
-            return True
-        else:
-            return False
+        braces, environments = self.unpack_state(self.previousBlockState())
+
+        for match in self.scanner.finditer(text):
+            name, format = self.groups[match.lastgroup]
+            if name == 'open':
+                braces += 1
+            elif name == 'close':
+                braces = max(0, braces - 1)
+            elif name == 'begin':
+                environments += 1
+            elif name == 'end':
+                environments = max(0, environments - 1)
+
+            if format is not None:
+                self.setFormat(match.start(), match.end() - match.start(), format)
+
+        self.setCurrentBlockState(self.pack_state(braces, environments))
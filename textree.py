@@ -0,0 +1,264 @@
+"""A parse tree of a formula that is kept up to date as the formula is edited.
+
+The tree has a node for every ``{}`` group, ``\\left...\\right`` pair and environment, with
+commands, scripts and characters as leaves.  Each node's position is stored relative to
+its parent, so an edit only re-parses the innermost group that contains it and shifts
+the siblings that follow along the path to the root; the rest of the tree is untouched.
+Looking up the node under an offset is a binary search at each level of nesting.
+"""
+from bisect import bisect_right
+from texvalidate import tokenize, environment_name, arity
+
+cursor_marker = r'{\color{red}|}'
+
+
+class Node:
+    __slots__ = ('kind', 'offset', 'length', 'head', 'tail', 'name', 'children')
+
+    def __init__(self, kind, offset, length=0, head=0, name=None):
+        self.kind = kind
+        # relative to the parent's start once the node is in a tree
+        self.offset = offset
+        self.length = length
+        # lengths of the opening and closing delimiters, e.g. 1 and 1 for a closed group
+        self.head = head
+        self.tail = 0
+        self.name = name
+        self.children = []
+
+    def is_container(self):
+        return self.kind in ('formula', 'group', 'left', 'env')
+
+    def __repr__(self):
+        return '<{} {}+{}{}>'.format(self.kind, self.offset, self.length,
+                                     ' ' + self.name if self.name else '')
+
+
+def parse(text, start=0, end=None):
+    """Parse ``text[start:end]`` and return ``(children, balanced)``.
+
+    Children have absolute offsets.  ``balanced`` is False when something was closed that
+    wasn't opened in this span or something opened in it is still open at the end.
+    """
+    end = len(text) if end is None else end
+    tokens = [(kind, start + s, start + e, t) for kind, s, e, t in tokenize(text[start:end])
+              if kind not in ('space', 'comment')]
+
+    root = Node('formula', start)
+    stack = [root]
+    # a backslash at the end of the span would have made a token with what follows it
+    balanced = not (tokens and tokens[-1][0] == 'backslash' and end < len(text))
+    i = 0
+
+    def close(node, close_end, tail):
+        node.length = close_end - node.offset
+        node.tail = tail
+        stack.pop()
+
+    while i < len(tokens):
+        kind, token_start, token_end, token = tokens[i]
+        i += 1
+        top = stack[-1]
+
+        if kind == 'open':
+            node = Node('group', token_start, head=1)
+            top.children.append(node)
+            stack.append(node)
+        elif kind == 'close':
+            if top.kind == 'group':
+                close(top, token_end, 1)
+            else:
+                balanced = False
+                top.children.append(Node('atom', token_start, token_end - token_start))
+        elif kind == 'command' and token in (r'\begin', r'\end'):
+            name, i, missing = environment_name(tokens, i)
+            if missing:
+                # a name still being typed is no environment yet
+                name = None
+            header_end = tokens[i - 1][2] if name is not None else token_end
+            if name is None:
+                balanced = False
+                top.children.append(Node('command', token_start, header_end - token_start))
+            elif token == r'\begin':
+                node = Node('env', token_start, head=header_end - token_start, name=name)
+                top.children.append(node)
+                stack.append(node)
+            elif top.kind == 'env' and top.name == name:
+                close(top, header_end, header_end - token_start)
+            else:
+                balanced = False
+                top.children.append(Node('command', token_start, header_end - token_start))
+        elif kind == 'command' and token in (r'\left', r'\right'):
+            # the delimiter belongs to the \left or \right
+            delimiter_end = token_end
+            if i < len(tokens):
+                delimiter_end = tokens[i][2]
+                i += 1
+            elif end < len(text):
+                # its delimiter is whatever follows the span
+                balanced = False
+            if token == r'\left':
+                node = Node('left', token_start, head=delimiter_end - token_start)
+                top.children.append(node)
+                stack.append(node)
+            elif top.kind == 'left':
+                close(top, delimiter_end, delimiter_end - token_start)
+            else:
+                balanced = False
+                top.children.append(Node('command', token_start, delimiter_end - token_start))
+        else:
+            leaf_kind = kind if kind in ('command', 'script') else 'atom'
+            top.children.append(Node(leaf_kind, token_start, token_end - token_start, name=token))
+
+    # anything still open runs to the end of the span
+    for node in stack[1:]:
+        balanced = False
+        node.length = end - node.offset
+    return root.children, balanced
+
+
+def relativize(nodes, base):
+    for node in nodes:
+        relativize(node.children, node.offset)
+        node.offset -= base
+    return nodes
+
+
+class TexTree:
+    """The parse tree of one formula.
+
+    ``edit`` takes the same arguments as QTextDocument.contentsChange plus the new text.
+    """
+
+    def __init__(self, text=''):
+        self.set_text(text)
+
+    def set_text(self, text):
+        self.text = text
+        self.root = Node('formula', 0, len(text))
+        children, _ = parse(text)
+        self.root.children = relativize(children, 0)
+
+    def edit(self, position, removed, added, text):
+        if len(self.text) - removed + added != len(text) or position + removed > len(self.text):
+            # not an edit we can follow, e.g. a change that includes the final paragraph
+            # separator of a QTextDocument
+            self.set_text(text)
+            return
+        if self.text[position:position + removed] == text[position:position + added]:
+            # a formatting-only change, the highlighter's for instance
+            self.text = text
+            return
+
+        delta = added - removed
+        # containers whose interior holds the whole edit, outermost first, with their
+        # absolute starts and the index of the child on the path in the parent
+        path = [(self.root, 0, None)]
+        while True:
+            node, node_start, _ = path[-1]
+            index = self._child_index(node, position - node_start)
+            if index < 0:
+                break
+            child = node.children[index]
+            child_start = node_start + child.offset
+            if not child.is_container():
+                break
+            interior_start = child_start + child.head
+            interior_end = child_start + child.length - child.tail
+            if not (interior_start <= position and position + removed <= interior_end):
+                break
+            # a container still open at the end of the text grows with whatever is typed there
+            path.append((child, child_start, index))
+
+        self.text = text
+        while len(path) > 1:
+            node, node_start, _ = path[-1]
+            interior_start = node_start + node.head
+            interior_end = node_start + node.length - node.tail + delta
+            children, balanced = parse(text, interior_start, interior_end)
+            # the first token after \left is its delimiter, so an edit there can change
+            # where the head ends: letters typed after \langle or \ run into its name, and a
+            # bare \left takes what is typed after it; the enclosing pair is parsed again
+            delimiter = node.kind == 'left' and all(
+                kind in ('space', 'comment')
+                for kind, _, _, _ in tokenize(text[interior_start:position]))
+            if balanced and not delimiter and (node.tail or interior_end == len(text)):
+                node.children = relativize(children, node_start)
+                self._resize(path, delta)
+                return
+            # the edit changed how this container is delimited; try the one around it
+            path.pop()
+
+        self.set_text(text)
+
+    @staticmethod
+    def _child_index(node, relative):
+        return bisect_right(node.children, relative, key=lambda child: child.offset) - 1
+
+    @staticmethod
+    def _resize(path, delta):
+        for depth in range(len(path) - 1, -1, -1):
+            node, _, index = path[depth]
+            node.length += delta
+            if index is not None:
+                for sibling in path[depth - 1][0].children[index + 1:]:
+                    sibling.offset += delta
+
+    def node_at(self, offset):
+        """Return ``[(node, absolute start), ...]`` from the root down to the innermost node
+        containing ``offset``."""
+        path = [(self.root, 0)]
+        while True:
+            node, node_start = path[-1]
+            index = self._child_index(node, offset - node_start)
+            if index < 0:
+                return path
+            child = node.children[index]
+            child_start = node_start + child.offset
+            if offset >= child_start + child.length:
+                return path
+            path.append((child, child_start))
+
+    def container_at(self, offset):
+        """The innermost group, \\left...\\right or environment whose contents include
+        ``offset``, with its absolute start."""
+        for node, start in reversed(self.node_at(offset)):
+            if node.is_container() and start + node.head <= offset <= start + node.length - node.tail:
+                return node, start
+        return self.root, 0
+
+    def cursor_position(self, offset):
+        """The position nearest ``offset`` where a cursor marker can be inserted without
+        splitting a token or separating a command from its arguments."""
+        node, start = self.node_at(offset)[-1]
+        end = start + node.length
+        if not node.is_container():
+            if start < offset < end:
+                offset = end
+        elif start < offset < start + node.head:
+            offset = start + node.head
+        elif node.tail and end - node.tail < offset < end:
+            offset = end
+
+        # right after a script or a command that takes arguments, the marker would become
+        # the argument, so it goes in front of it instead
+        if offset < len(self.text):
+            parent, parent_start = self.node_at(max(0, offset - 1))[-1]
+            if parent is not None and not parent.is_container() and \
+                    parent_start + parent.length == offset and \
+                    (parent.kind == 'script' or parent.name in arity):
+                offset = parent_start
+        return offset
+
+    def cursor_marked(self, offset, marker=cursor_marker):
+        offset = self.cursor_position(offset)
+        return self.text[:offset] + marker + self.text[offset:]
+
+    def selection_marked(self, start, end, color='red'):
+        """Color the selected part of the formula, or return None when the selection
+        doesn't fit inside a single group."""
+        start, end = self.cursor_position(start), self.cursor_position(end)
+        if start >= end or self.container_at(start) != self.container_at(end):
+            return None
+        return '{}{{\\color{{{}}}{}}}{}'.format(self.text[:start], color, self.text[start:end],
+                                             self.text[end:])
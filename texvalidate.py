@@ -0,0 +1,215 @@
+"""A fast check of TeX input before it is sent to MathJax.
+
+``classify`` sorts a formula into one of three states:
+
+- ``COMPLETE``: nothing is missing, render it as is
+- ``RECOVERABLE``: something is still open (a ``{``, a trailing ``^``/``_``, a ``\\left``
+  without ``\\right``, a ``\\begin`` without ``\\end``, a ``\\sqrt[`` index or environment
+  name being typed, or a command missing arguments) and can be rendered with tentative
+  closers added at the end
+- ``BROKEN``: something that no amount of typing further along will fix, such as an
+  unmatched ``}`` or a ``\\right`` without ``\\left``, so there is no point rendering it
+
+Only the subset of TeX used in formulas is understood; anything else is passed through.
+"""
+import re
+
+COMPLETE = 'complete'
+RECOVERABLE = 'recoverable'
+BROKEN = 'broken'
+
+token_pattern = re.compile(r'''
+    (?P<command>\\[A-Za-z]+\*?)
+  | (?P<escape>\\.)
+  | (?P<backslash>\\$)
+  | (?P<comment>%[^\n]*)
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<script>[_^])
+  | (?P<space>\s+)
+  | (?P<char>.)
+''', re.VERBOSE | re.DOTALL)
+
+# commands whose mandatory arguments get tentative {} when they are still missing
+arity = {
+    r'\frac': 2, r'\dfrac': 2, r'\tfrac': 2, r'\cfrac': 2, r'\binom': 2, r'\dbinom': 2,
+    r'\tbinom': 2, r'\overset': 2, r'\underset': 2, r'\stackrel': 2,
+    r'\sqrt': 1, r'\hat': 1, r'\widehat': 1, r'\bar': 1, r'\vec': 1, r'\dot': 1, r'\ddot': 1,
+    r'\tilde': 1, r'\widetilde': 1, r'\overline': 1, r'\underline': 1, r'\overbrace': 1,
+    r'\underbrace': 1, r'\mathbf': 1, r'\mathrm': 1, r'\mathit': 1, r'\mathcal': 1,
+    r'\mathbb': 1, r'\mathfrak': 1, r'\mathsf': 1, r'\mathtt': 1, r'\boldsymbol': 1,
+    r'\text': 1, r'\textbf': 1, r'\textit': 1, r'\operatorname': 1, r'\pmod': 1,
+}
+
+
+def tokenize(formula:str):
+    """Yield ``(kind, start, end, text)`` for each token of ``formula``."""
+    for match in token_pattern.finditer(formula):
+        yield match.lastgroup, match.start(), match.end(), match.group()
+
+
+class Frame:
+    """Something open: the whole formula, a ``{`` group, a ``\\left`` or an environment."""
+    __slots__ = ('kind', 'name', 'owed')
+
+    def __init__(self, kind, name=None):
+        self.kind = kind
+        self.name = name
+        # arguments still owed by pending commands and scripts here, innermost last,
+        # as [count, is_script]
+        self.owed = []
+
+    def complete_atom(self):
+        # one complete argument arrived; a command whose last argument this was is itself
+        # complete, and so counts as an argument of whatever is pending before it
+        while self.owed:
+            self.owed[-1][0] -= 1
+            if self.owed[-1][0] > 0:
+                return
+            self.owed.pop()
+
+    def closer(self):
+        if self.kind == '{':
+            return '}'
+        elif self.kind == 'left':
+            return r'\right.'
+        elif self.kind == 'env':
+            return r'\end{' + self.name + '}'
+        return ''
+
+
+class Broken(Exception):
+    pass
+
+
+def classify(formula:str):
+    """Return ``(state, formula)``, where ``formula`` has tentative closers added if needed."""
+    try:
+        frames, suffix = scan(formula)
+    except Broken:
+        return BROKEN, formula
+
+    for frame in reversed(frames):
+        while frame.owed:
+            suffix += '{}'
+            frame.complete_atom()
+        suffix += frame.closer()
+        if frame is not frames[0]:
+            frames[frames.index(frame) - 1].complete_atom()
+
+    if not suffix:
+        return COMPLETE, formula
+    last_line = list(tokenize(formula[formula.rfind('\n') + 1:]))
+    if any(kind == 'comment' for kind, _, _, _ in last_line):
+        # the closers would be commented out along with the rest of the last line
+        suffix = '\n' + suffix
+    elif last_line and last_line[-1][0] == 'backslash':
+        # or the first of them escaped by a backslash typed at the end
+        suffix = ' ' + suffix
+    return RECOVERABLE, formula + suffix
+
+
+def scan(formula):
+    """Return the frames still open at the end of ``formula`` and any delimiter it is
+    missing, or raise Broken."""
+    tokens = [token for token in tokenize(formula) if token[0] not in ('space', 'comment')]
+    frames = [Frame('formula')]
+    i = 0
+
+    def next_token():
+        return tokens[i] if i < len(tokens) else None
+
+    while i < len(tokens):
+        kind, _, _, text = tokens[i]
+        i += 1
+        frame = frames[-1]
+        script_pending = bool(frame.owed) and frame.owed[-1][1]
+
+        if kind == 'backslash':
+            raise Broken()
+        elif kind == 'open':
+            frames.append(Frame('{'))
+        elif kind == 'close':
+            if frame.kind != '{' or frame.owed:
+                raise Broken()
+            frames.pop()
+            frames[-1].complete_atom()
+        elif kind == 'script':
+            if script_pending:
+                raise Broken()
+            frame.owed.append([1, True])
+        elif (kind == 'char' and text == '&') or (kind == 'escape' and text == '\\\\'):
+            # column and row separators can't stand in for a missing argument
+            if frame.owed:
+                raise Broken()
+        elif kind == 'command' and text in (r'\left', r'\right'):
+            if text == r'\right':
+                if frame.kind != 'left' or frame.owed:
+                    raise Broken()
+                frames.pop()
+            if text == r'\left':
+                frames.append(Frame('left'))
+            if next_token() is None:
+                # still waiting for the delimiter
+                return frames, '.'
+            i += 1
+            if text == r'\right':
+                frames[-1].complete_atom()
+        elif kind == 'command' and text in (r'\begin', r'\end'):
+            name, i, missing = environment_name(tokens, i)
+            if name is None:
+                raise Broken()
+            if missing:
+                # the formula ends while the name is still being typed
+                opening = '{' if missing == '{' else ''
+                if text == r'\begin':
+                    frames.append(Frame('env', name))
+                    return frames, opening + '}'
+                if frame.kind != 'env' or not frame.name.startswith(name) or frame.owed:
+                    raise Broken()
+                frames.pop()
+                frames[-1].complete_atom()
+                return frames, opening + frame.name[len(name):] + '}'
+            if text == r'\begin':
+                frames.append(Frame('env', name))
+            elif frame.kind != 'env' or frame.name != name or frame.owed:
+                raise Broken()
+            else:
+                frames.pop()
+                frames[-1].complete_atom()
+        elif kind == 'command' and text in arity:
+            if text == r'\sqrt' and next_token() is not None and next_token()[3] == '[':
+                # skip the optional root index
+                while next_token() is not None and next_token()[3] != ']':
+                    i += 1
+                if next_token() is None:
+                    # the index is still being typed
+                    frame.owed.append([arity[text], False])
+                    return frames, ']'
+                i += 1
+            frame.owed.append([arity[text], False])
+        else:
+            frame.complete_atom()
+
+    return frames, ''
+
+
+def environment_name(tokens, i):
+    """Read ``{name}`` following \\begin or \\end; returns ``(name, next index, missing)``.
+    If the formula ends before the name does, ``missing`` is what it still needs to start
+    (``{``) or to finish (``}``) it, otherwise it is empty."""
+    if i >= len(tokens):
+        return '', i, '{'
+    if tokens[i][0] != 'open':
+        return None, i, ''
+
+    name = []
+    i += 1
+    while i < len(tokens) and tokens[i][0] != 'close':
+        if tokens[i][0] != 'char':
+            return None, i, ''
+        name.append(tokens[i][3])
+        i += 1
+    if i >= len(tokens):
+        return ''.join(name), i, '}'
+    return ''.join(name), i + 1, ''